@@ -0,0 +1,296 @@
+"""handle_message のオフラインベンチマーク（Discord・Geminiは偽物を使う）
+
+N ギルド × M チャンネルに合成メッセージを流し、以下をJSONで出力する。
+  - スループット、メッセージ全体と段階ごと（チャンネルキュー待ち・Gemini・Discord送信）の p50/p99 レイテンシ
+  - チャンネルワーカーの起動・終了・拒否の回数、イベントループの遅延
+  - message_buffer_per_ch / chats_per_ch とプロセス全体のメモリ増加
+
+使い方: python bench/bench_handle_message.py --guilds 10 --channels 20 --messages 20 --latency 0.2 --output bench_output.txt
+ネットワークやトークンは不要（requirements.txt のパッケージのみ必要）
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+import config
+import funcs
+import gemini_client
+import context_window
+import session_log
+import rate_limiter
+import shared_state
+import metrics
+import channel_workers
+
+BOT_USER_ID = 999
+stage_times = {"channel_queue_wait": [], "gemini": [], "discord_send": [], "message_total": []}
+
+# ===== 偽Discord =====
+
+class FakeUser:
+    def __init__(self, user_id, bot=False):
+        self.id = user_id
+        self.bot = bot
+        self.display_name = f"user{user_id}"
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+class FakeSentMessage:
+    def __init__(self, content, channel):
+        self.content = content
+        self.channel = channel
+
+    async def edit(self, content=None):
+        start = time.perf_counter()
+        await asyncio.sleep(0)
+        self.content = content
+        stage_times["discord_send"].append(time.perf_counter() - start)
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+class FakeChannel:
+    def __init__(self, channel_id, send_latency):
+        self.id = channel_id
+        self.send_latency = send_latency
+
+    async def send(self, content=None, file=None):
+        start = time.perf_counter()
+        await asyncio.sleep(self.send_latency)
+        stage_times["discord_send"].append(time.perf_counter() - start)
+        return FakeSentMessage(content, self)
+
+    def typing(self):
+        return FakeTyping()
+
+class FakeMessage:
+    def __init__(self, guild, channel, author, content, mentions):
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.mentions = mentions
+        self.attachments = []
+
+class FakeClient:
+    user = FakeUser(BOT_USER_ID, bot=True)
+
+# ===== 偽Gemini =====
+
+class StubPart:
+    def __init__(self, text):
+        self.text = text
+
+class StubContent:
+    def __init__(self, role, text):
+        self.role = role
+        self.parts = [StubPart(text)]
+
+class StubUsage:
+    def __init__(self, tokens):
+        self.prompt_token_count = tokens
+        self.candidates_token_count = 20
+        self.total_token_count = tokens + 20
+
+class StubChunk:
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.usage_metadata = usage
+
+class StubChat:
+    def __init__(self, latency, history=None):
+        self.latency = latency
+        self.history = list(history or [])
+
+    def get_history(self, curated=False):
+        return self.history
+
+    async def send_message_stream(self, message, config=None):
+        async def chunks():
+            start = time.perf_counter()
+            reply = "了解しました。" * 5
+            for i in range(5):
+                await asyncio.sleep(self.latency / 5)
+                usage = StubUsage(len(message) // 2) if i == 4 else None
+                yield StubChunk(reply[i * 7:(i + 1) * 7], usage)
+            # google-genai と同じく、断片ごとにモデルのターンとして記録する
+            self.history += [StubContent("user", message)]
+            self.history += [StubContent("model", reply[i * 7:(i + 1) * 7]) for i in range(5)]
+            stage_times["gemini"].append(time.perf_counter() - start)
+        return chunks()
+
+    async def send_message(self, message, config=None):
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        reply = "了解しました。" * 5
+        self.history += [StubContent("user", message), StubContent("model", reply)]
+        stage_times["gemini"].append(time.perf_counter() - start)
+        response = StubChunk(reply, StubUsage(len(message) // 2))
+        return response
+
+# ===== 計測用フック =====
+
+original_observe = metrics.observe
+
+# funcs が記録する段階ごとの時間のうち、集計対象のものを控える
+def recording_observe(stage, seconds):
+    if stage in stage_times and stage not in ("gemini", "discord_send"):
+        stage_times[stage].append(seconds)
+    original_observe(stage, seconds)
+
+# ===== 計測 =====
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def summarize_ms(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 3) if values else None,
+        "p99_ms": round(percentile(values, 99) * 1000, 3) if values else None,
+        "max_ms": round(max(values) * 1000, 3) if values else None,
+    }
+
+# イベントループの遅延を測る監視タスク
+async def monitor_loop_lag(interval, lags, stop):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - expected))
+
+def state_sizes(chats_per_ch):
+    buffers = [b for channels in funcs.message_buffer_per_ch.values() for b in channels.values()]
+    return {
+        "chats": sum(len(channels) for channels in chats_per_ch.values()),
+        "chat_turns": sum(len(c.history) for channels in chats_per_ch.values() for c in channels.values()),
+        "buffers": len(buffers),
+        "buffer_messages": sum(len(b) for b in buffers),
+        "buffer_bytes": sum(b.total_bytes for b in buffers),
+    }
+
+async def fake_count_tokens(api_key, model, content):
+    return len(context_window.turn_text(content)) // 2
+
+def install_fakes(args, workdir):
+    config.allowed_channels_per_guild = {
+        str(g): [g * 1000 + c for c in range(args.channels)] for g in range(1, args.guilds + 1)
+    }
+    config.rebuild_channel_index()
+    config.CHAT_CONFIG_DIR = os.path.join(workdir, "chat_config")
+    funcs.SAVED_CHAT_DIR = os.path.join(workdir, "saved_chat")
+    session_log.SESSION_ROOT = os.path.join(workdir, "sessions")
+    shared_state.LEASE_DIR = os.path.join(workdir, "leases")
+    funcs.ready(FakeClient(), "bench-token")
+    metrics.observe = recording_observe
+    gemini_client.create_chat = lambda api_key, model, inst="", history=None: StubChat(args.latency, history)
+    context_window.count_turn_tokens = fake_count_tokens
+    rate_limiter.schedulers["bench-token"] = rate_limiter.GeminiScheduler(10 ** 9, 10 ** 12)
+
+def build_messages(args):
+    rng = random.Random(args.seed)
+    guilds = {g: FakeGuild(g) for g in range(1, args.guilds + 1)}
+    messages = []
+    for g, guild in guilds.items():
+        for c in range(args.channels):
+            channel = FakeChannel(g * 1000 + c, args.send_latency)
+            for i in range(args.messages):
+                author = FakeUser(rng.randint(1, 5))
+                if rng.random() < args.mention_ratio:
+                    messages.append(FakeMessage(guild, channel, author, f"<@{BOT_USER_ID}> 質問{i}です", [FakeClient.user]))
+                else:
+                    messages.append(FakeMessage(guild, channel, author, f"雑談メッセージ{i} " + "あ" * rng.randint(5, 200), []))
+    rng.shuffle(messages)
+    return messages
+
+async def timed_handle(message, chats_per_ch):
+    start = time.perf_counter()
+    await funcs.handle_message(message, chats_per_ch)
+    stage_times["message_total"].append(time.perf_counter() - start)
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        install_fakes(args, workdir)
+        messages = build_messages(args)
+        chats_per_ch = {}
+
+        lags, stop = [], asyncio.Event()
+        monitor = asyncio.create_task(monitor_loop_lag(0.01, lags, stop))
+        tracemalloc.start()
+        mem_before = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        tasks = []
+        for message in messages:
+            tasks.append(asyncio.create_task(timed_handle(message, chats_per_ch)))
+            if args.interval:
+                await asyncio.sleep(args.interval)
+        await asyncio.gather(*tasks)
+        # ワーカーに渡したメッセージ（追いかけ返答を含む）の処理が終わるまで待つ
+        while channel_workers.queued_events() or channel_workers.busy_workers():
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+
+        mem_after, mem_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stop.set()
+        await monitor
+
+        return {
+            "params": vars(args),
+            "messages": len(messages),
+            "elapsed_s": round(elapsed, 3),
+            "throughput_msg_per_s": round(len(messages) / elapsed, 1),
+            "stages": {name: summarize_ms(values) for name, values in stage_times.items()},
+            "workers": dict(channel_workers.stats, active=len(channel_workers.workers)),
+            "loop_lag": summarize_ms(lags),
+            "memory": {
+                "traced_growth_bytes": mem_after - mem_before,
+                "traced_peak_bytes": mem_peak,
+                "state": state_sizes(chats_per_ch),
+            },
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=20, help="チャンネルあたりのメッセージ数")
+    parser.add_argument("--mention-ratio", type=float, default=0.2)
+    parser.add_argument("--latency", type=float, default=0.2, help="偽Geminiの応答時間（秒）")
+    parser.add_argument("--send-latency", type=float, default=0.01, help="偽Discord送信の所要時間（秒）")
+    parser.add_argument("--interval", type=float, default=0.0, help="メッセージ到着間隔（秒）")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="結果JSONの出力先（省略時は標準出力）")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
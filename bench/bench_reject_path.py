@@ -0,0 +1,67 @@
+"""許可されていないチャンネルのメッセージを捨てる処理の速さを測るマイクロベンチマーク
+
+使い方: python bench/bench_reject_path.py [--iterations N] [--max-us 5.0]
+ネットワークやトークンは不要（requirements.txt のパッケージのみ必要）
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+import config
+import funcs
+
+class FakeUser:
+    def __init__(self, user_id, bot=False):
+        self.id = user_id
+        self.bot = bot
+        self.display_name = f"user{user_id}"
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+class FakeMessage:
+    def __init__(self, guild_id, channel_id, content="こんにちは"):
+        self.guild = FakeGuild(guild_id)
+        self.channel = FakeChannel(channel_id)
+        self.author = FakeUser(1)
+        self.content = content
+        self.mentions = []
+
+class FakeClient:
+    user = FakeUser(999, bot=True)
+
+async def run(iterations):
+    # 大規模ギルドを想定して許可チャンネルを多めに登録
+    config.allowed_channels_per_guild = {str(g): list(range(g * 1000, g * 1000 + 50)) for g in range(1, 201)}
+    config.rebuild_channel_index()
+    funcs.ready(FakeClient(), "dummy-token")
+
+    messages = [FakeMessage(g, g * 1000 + 500) for g in range(1, 201)]
+    chats_per_ch = {}
+    start = time.perf_counter()
+    for i in range(iterations):
+        await funcs.handle_message(messages[i % len(messages)], chats_per_ch)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200000)
+    parser.add_argument("--max-us", type=float, default=5.0, help="1メッセージあたりの許容時間（マイクロ秒）")
+    args = parser.parse_args()
+
+    per_call = asyncio.run(run(args.iterations))
+    print(f"reject path: {per_call:.2f} us/message ({args.iterations} messages)")
+    if per_call > args.max_us:
+        print(f"NG: {args.max_us} us を超えています")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""大きなチャット履歴の !save_chat / !load_chat 中にイベントループが止まらないことを確かめるベンチマーク
+
+数MBの履歴で funcs.save_chat と funcs.load_chat を実行しながら、短い間隔で loop.time() のずれ（遅延）を測り、
+最大遅延が --max-lag-ms を超えたら終了コード1で終わる
+稼働中のbotと同じく、他のチャンネルの会話（--resident-chats × --resident-turns）をメモリに置いた状態で測る
+（世代2のGCはこれらも走査するため、空に近いプロセスで測ると実際より短く見える）
+使い方: python bench/bench_save_load_lag.py [--turns 3000] [--turn-chars 1000] [--rounds 3] [--max-lag-ms 50]
+                                          [--resident-chats 200] [--resident-turns 200]
+ネットワークやトークンは不要（requirements.txt のパッケージのみ必要）
+"""
+import os
+import gc
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+from google.genai.types import Content, Part
+import config
+import funcs
+import gemini_client
+
+SAMPLE_INTERVAL = 0.005  # 遅延を測る間隔（秒）
+RESIDENT_TURN_CHARS = 300  # メモリに置いておく他の会話の1ターンあたりの文字数
+
+class StubChat:
+    def __init__(self, history=None):
+        self.history = list(history or [])
+
+    def get_history(self, curated=False):
+        return self.history
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+class FakeClient:
+    user = FakeUser(999)
+
+def build_history(turns, turn_chars):
+    text = ("長い会話の一部です。Lorem ipsum dolor sit amet. " * (turn_chars // 30 + 1))[:turn_chars]
+    return [
+        Content(role="user" if i % 2 == 0 else "model", parts=[Part(text=f"{i}: {text}")])
+        for i in range(turns)
+    ]
+
+# 世代2のGCの回数と所要時間を記録する
+def track_full_collections(durations):
+    started = []
+
+    def callback(phase, info):
+        if info["generation"] != 2:
+            return
+        if phase == "start":
+            started.append(time.perf_counter())
+        elif started:
+            durations.append(time.perf_counter() - started.pop())
+
+    gc.callbacks.append(callback)
+    return callback
+
+# イベントループの遅延を測る監視タスク
+async def monitor_loop_lag(lags, stop):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + SAMPLE_INTERVAL
+        await asyncio.sleep(SAMPLE_INTERVAL)
+        lags.append(max(0.0, loop.time() - expected))
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="bench_save_load_")
+    try:
+        funcs.SAVED_CHAT_DIR = os.path.join(workdir, "saved_chat")
+        config.CHAT_CONFIG_DIR = os.path.join(workdir, "chat_config")
+        funcs.ready(FakeClient(), "bench-token")
+        gemini_client.create_chat = lambda api_key, model, inst="", history=None: StubChat(history)
+        config_path = config.chat_config_path("1", 1000)
+        os.makedirs(os.path.dirname(config_path), exist_ok=True)
+        with open(config_path, "w", encoding="utf-8") as f:
+            f.write("ベンチマーク用の設定です。\n" * 100)
+
+        resident = [StubChat(build_history(args.resident_turns, RESIDENT_TURN_CHARS)) for _ in range(args.resident_chats)]
+        chat = StubChat(build_history(args.turns, args.turn_chars))
+        size = sum(len(part.text.encode("utf-8")) for content in chat.history for part in content.parts)
+        # 準備で作ったオブジェクトの分の世代2のGCを、計測の前に済ませておく（稼働中のbotでは済んでいるもの）
+        gc.collect()
+
+        collections = []
+        callback = track_full_collections(collections)
+        lags, stop = [], asyncio.Event()
+        monitor = asyncio.create_task(monitor_loop_lag(lags, stop))
+        timings = {"save": [], "load": []}
+        for i in range(args.rounds):
+            start = time.perf_counter()
+            name = await funcs.save_chat(chat, config_path, "1", funcs.SAVED_CHAT_DIR, name=f"bench{i}")
+            timings["save"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            loaded = await funcs.load_chat("1", name, 1000, config_path)
+            timings["load"].append(time.perf_counter() - start)
+            if loaded is None or len(loaded.history) != args.turns:
+                raise RuntimeError(f"読み込んだ履歴が一致しません: {name}")
+        stop.set()
+        await monitor
+        gc.callbacks.remove(callback)
+        del resident
+        return size, timings, lags, collections
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=3000)
+    parser.add_argument("--turn-chars", type=int, default=1000, help="1ターンあたりの文字数")
+    parser.add_argument("--rounds", type=int, default=3, help="保存と読み込みを繰り返す回数")
+    parser.add_argument("--max-lag-ms", type=float, default=50.0, help="許容するイベントループの最大遅延（ミリ秒）")
+    parser.add_argument("--resident-chats", type=int, default=200, help="メモリに置いておく他のチャンネルの会話の数")
+    parser.add_argument("--resident-turns", type=int, default=200, help="他のチャンネルの会話1つあたりのターン数")
+    args = parser.parse_args()
+
+    size, timings, lags, collections = asyncio.run(run(args))
+    max_lag = max(lags, default=0.0) * 1000
+    print(f"history: {args.turns} turns, {size / 1024 / 1024:.1f} MB")
+    for kind, values in timings.items():
+        print(f"{kind}: 平均 {sum(values) / len(values) * 1000:.0f} ms ({len(values)}回)")
+    print(f"resident: {args.resident_chats} chats x {args.resident_turns} turns")
+    print(f"gen2 GC: {len(collections)}回 (max {max(collections, default=0.0) * 1000:.1f} ms)")
+    print(f"loop lag: max {max_lag:.1f} ms ({len(lags)} samples)")
+    if max_lag > args.max_lag_ms:
+        print(f"NG: {args.max_lag_ms} ms を超えています")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
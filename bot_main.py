@@ -1,107 +1,125 @@
-import discord
-import os
-import sys
-import importlib
-
-# モジュール読み込みパス追加
-sys.path.append('/app/shared')
-import commands
-import config
-import funcs
-
-chats_per_ch = {}
-
-# 起動・トークンを.envから取得
-config.load_env()
-GEMINI_TOKEN = config.GEMINI_TOKEN
-DISCORD_TOKEN = config.DISCORD_TOKEN
-
-# 接続オブジェクト
-intents = discord.Intents.default()
-intents.message_content = True
-client = discord.Client(intents=intents)
-# コマンドツリー初期化
-tree = discord.app_commands.CommandTree(client)
-
-# モジュール初期化
-async def initialize_bot():
-    global client
-
-    # モジュール再読み込み
-    importlib.reload(funcs)
-    importlib.reload(commands)
-    importlib.reload(config)
-
-    # コンフィグ
-    config.load_allowed_channels()
-    commands.reloadconfig()
-    funcs.ready(client, GEMINI_TOKEN)
-    # コマンド一覧を確認
-    try:
-        # グローバルコマンドを取得
-        global_commands = await tree.fetch_commands()
-        print("登録されているグローバルコマンド一覧:")
-        if not global_commands:
-            print("  登録されているグローバルコマンドはありません")
-        for command in global_commands:
-            print(f" - {command.name}")
-    except Exception as e:
-        print(f"グローバルコマンドの取得に失敗: {e}")
-    # guild command
-    for guild in client.guilds:
-        commands_list = await tree.fetch_commands(guild=guild)
-        print(f"{guild.name} のコマンド一覧:")
-        if not commands_list:
-            print("  登録されているコマンドはありません")
-        for command in commands_list:
-            print(f" - {command.name}")
-
-# /reload_modules コマンド定義
-@tree.command(name="reload_modules", description="モジュールをリロードします")
-@discord.app_commands.checks.has_permissions(administrator=True)
-async def reload_modules(interaction: discord.Interaction):
-    await initialize_bot()
-    await interaction.response.send_message("モジュールをリロードしました", ephemeral=True)
-
-# 起動時イベント
-@client.event
-async def on_ready():
-    await initialize_bot()
-    commands.setup(tree)
-
-    # グローバルコマンドの同期
-    try:
-        await tree.sync(guild=None)  # これでグローバルコマンドがすべてのギルドに反映されます
-        print("グローバルコマンドを同期しました")
-    except Exception as e:
-        print(f"グローバルコマンドの同期に失敗: {e}")
-
-    for guild in client.guilds:
-        try:
-            # コマンドを同期
-            await tree.sync(guild=guild)
-            print(f"{guild.name} にコマンドを同期しました")
-            
-            # 同期後にコマンド一覧を確認
-            commands_list = await tree.fetch_commands(guild=guild)
-            print(f"{guild.name} のコマンド一覧:")
-            if not commands_list:
-                print("  登録されているコマンドはありません")
-            for command in commands_list:
-                print(f" - {command.name}")
-        except Exception as e:
-            print(f"{guild.name} への同期に失敗: {e}")
-    print(f"ログイン成功: {client.user}")
-
-# メッセージ処理
-@client.event
-async def on_message(message):
-    # on_messageが呼ばれているか確認。ねこはどこのチャンネルにもでます
-    if message.content == '!neko':
-        await message.channel.send('にゃーん')
-    try:
-        await funcs.handle_message(message, config.allowed_channels_per_guild, chats_per_ch)
-    except Exception as e:
-        print(f"handle_message でエラー: {e}")
-
+import discord
+import os
+import sys
+import asyncio
+
+# モジュール読み込みパス追加
+sys.path.append('/app/shared')
+import commands
+import command_sync
+import config
+import funcs
+import hot_reload
+import metrics
+import shared_state
+import state_backend
+
+chats_per_ch = {}
+channel_watcher = None  # 応答チャンネル設定ファイルの監視タスク
+session_evictor_task = None  # 使われていない会話をメモリから退避するタスク
+startup_done = False  # on_ready の初期化が済んだか
+# /reload_modules で再読み込みするモジュール（依存される側から順に）
+RELOAD_ORDER = (
+    "storage", "shared_state", "state_backend", "config", "metrics", "rate_limiter", "gemini_client",
+    "instruction_store", "chat_archive", "chat_catalog", "chat_search", "chat_export", "context_window",
+    "session_log", "message_buffer", "context_cache", "reply_sender", "attachments", "channel_workers",
+    "session_evictor", "funcs", "commands", "command_sync",
+)
+
+# 起動・トークンを.envから取得
+config.load_env()
+GEMINI_TOKEN = config.GEMINI_TOKEN
+DISCORD_TOKEN = config.DISCORD_TOKEN
+METRICS_HOST, METRICS_PORT = config.METRICS_HOST, config.METRICS_PORT
+
+# 接続オブジェクト（SHARD_COUNT を指定した場合はシャード分割。SHARD_IDS で受け持つシャードを選ぶ）
+intents = discord.Intents.default()
+intents.message_content = True
+if config.SHARD_COUNT is None:
+    client = discord.Client(intents=intents)
+else:
+    client = discord.AutoShardedClient(
+        intents=intents,
+        shard_count=config.SHARD_COUNT or None,
+        shard_ids=config.SHARD_IDS
+    )
+# コマンドツリー初期化
+tree = discord.app_commands.CommandTree(client)
+
+# モジュール初期化（reload=True のときは実行中の状態を引き継いで再読み込み）
+async def initialize_bot(reload=False):
+    global client
+
+    # モジュール再読み込み
+    if reload:
+        hot_reload.reload_modules(RELOAD_ORDER)
+
+    # コンフィグ（保存先は同じbotの全シャードで共有）
+    if config.backend is None:
+        config.use_backend(state_backend.open_backend(client.user.id))
+    config.load_allowed_channels()
+    commands.reloadconfig()
+    funcs.ready(client, GEMINI_TOKEN)
+
+# 登録したコマンド一覧を表示（APIは呼ばない）
+def print_command_lists():
+    print("登録されているグローバルコマンド一覧:")
+    global_commands = tree.get_commands()
+    if not global_commands:
+        print("  登録されているグローバルコマンドはありません")
+    for command in global_commands:
+        print(f" - {command.name}")
+
+# /reload_modules コマンド定義
+@tree.command(name="reload_modules", description="モジュールをリロードします")
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def reload_modules(interaction: discord.Interaction):
+    try:
+        await initialize_bot(reload=True)
+    except Exception as e:
+        await interaction.response.send_message(f"リロードに失敗しました: {e}", ephemeral=True)
+        return
+    await interaction.response.send_message("モジュールをリロードしました", ephemeral=True)
+
+# 起動時イベント（再接続でも呼ばれるため、初回のみ初期化する）
+@client.event
+async def on_ready():
+    global startup_done, channel_watcher, session_evictor_task
+    if startup_done:
+        print(f"再接続しました: {client.user}")
+        return
+    startup_done = True
+    await initialize_bot()
+    # ローカルのメトリクスエンドポイント
+    if METRICS_PORT:
+        try:
+            await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        except Exception as e:
+            print(f"メトリクスの公開に失敗: {e}")
+    # 他のシャード・botによる応答チャンネルの変更を取り込む
+    if channel_watcher is None:
+        channel_watcher = asyncio.create_task(shared_state.watch(
+            lambda: config.channels_revision(), lambda: config.load_allowed_channels(), config.CHANNELS_NAMESPACE
+        ))
+    if session_evictor_task is None:
+        session_evictor_task = asyncio.create_task(funcs.run_session_evictor(chats_per_ch))
+    commands.setup(tree)
+    print_command_lists()
+
+    # 登録内容が変わったスコープ（グローバル・ギルド）だけ同期
+    await command_sync.sync_commands(tree, client, sync_global=config.is_primary_shard())
+
+    print(f"ログイン成功: {client.user}")
+
+# メッセージ処理
+@client.event
+async def on_message(message):
+    # on_messageが呼ばれているか確認。ねこはどこのチャンネルにもでます
+    if message.content == '!neko':
+        await message.channel.send('にゃーん')
+    try:
+        await funcs.handle_message(message, chats_per_ch)
+    except Exception as e:
+        print(f"handle_message でエラー: {e}")
+
 client.run(DISCORD_TOKEN)
\ No newline at end of file
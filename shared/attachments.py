@@ -0,0 +1,176 @@
+import io
+import time
+import asyncio
+import hashlib
+import mimetypes
+from collections import OrderedDict, deque
+from google.genai import types
+import gemini_client
+
+# 添付ファイルを読み込んで Gemini に渡す Part に変換する
+# テキストはそのまま本文として、画像・PDF・音声は Files API にアップロードしてURIで渡す
+# 内容のハッシュでキャッシュし、同じファイルの再投稿では再変換・再アップロードしない
+MAX_FILE_BYTES = 10 * 1024 * 1024  # 1ファイルあたりの上限
+MAX_MESSAGE_BYTES = 20 * 1024 * 1024  # 1メッセージあたりの上限
+GUILD_BYTES_PER_HOUR = 200 * 1024 * 1024  # ギルドごとの1時間あたりの読み込み上限
+GUILD_WINDOW = 60 * 60  # 上限を数える期間（秒）
+MAX_TEXT_CHARS = 20000  # テキスト添付として本文に入れる最大文字数
+DOWNLOAD_CONCURRENCY = 4  # 同時に読み込む添付ファイル数（全体）
+CACHE_SIZE = 256  # 保持する変換結果の数
+UPLOAD_TTL = 47 * 60 * 60  # アップロードしたファイルを使い回す期間（Files APIの保持期間は48時間）
+TEXT_TYPES = {"application/json", "application/xml", "application/x-yaml", "application/javascript", "application/x-sh"}
+TEXT_EXTENSIONS = {".txt", ".md", ".csv", ".json", ".yaml", ".yml", ".xml", ".log", ".py", ".js", ".ts", ".html", ".css"}
+UPLOAD_PREFIXES = ("image/", "audio/", "application/pdf")
+
+parts_cache = OrderedDict()  # 内容のハッシュ -> {"part": Part, "expires": 期限(monotonic) または None}
+upload_expires = {}  # アップロードしたファイルのURI -> 使える期限(monotonic)。履歴に残したファイルの期限確認用
+attachment_hashes = OrderedDict()  # 添付ファイルID -> 内容のハッシュ（同じ添付の再読み込みを避ける）
+guild_usage = {}  # guild_id -> deque((時刻, バイト数))
+download_semaphore = None
+RUNTIME_STATE = ("parts_cache", "upload_expires", "attachment_hashes", "guild_usage", "download_semaphore")  # 再読み込みで引き継ぐ
+
+class GeminiFileUploader:
+    async def upload(self, api_key, data, mime_type, name):
+        file = await gemini_client.get_client(api_key).aio.files.upload(
+            file=io.BytesIO(data),
+            config=types.UploadFileConfig(mime_type=mime_type, display_name=name)
+        )
+        return file.uri
+
+# テストではローカルのスタブ（upload を持つオブジェクト）に差し替える
+uploader = GeminiFileUploader()
+
+def get_download_semaphore():
+    global download_semaphore
+    if download_semaphore is None:
+        download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    return download_semaphore
+
+def mime_type_of(attachment):
+    mime = (attachment.content_type or "").split(";")[0].strip()
+    return mime or mimetypes.guess_type(attachment.filename)[0] or "application/octet-stream"
+
+def is_text(attachment, mime):
+    extension = "." + attachment.filename.rsplit(".", 1)[-1].lower() if "." in attachment.filename else ""
+    return mime.startswith("text/") or mime in TEXT_TYPES or extension in TEXT_EXTENSIONS
+
+def is_supported(attachment):
+    mime = mime_type_of(attachment)
+    return is_text(attachment, mime) or mime.startswith(UPLOAD_PREFIXES)
+
+def _remember(cache, key, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+def _cached_part(digest):
+    entry = parts_cache.get(digest)
+    if entry is None:
+        return None
+    if entry["expires"] is not None and entry["expires"] <= time.monotonic():
+        del parts_cache[digest]
+        return None
+    parts_cache.move_to_end(digest)
+    return entry["part"]
+
+# ギルドの読み込み枠を確保（足りなければFalse）
+def _reserve_guild_bytes(guild_id, size):
+    now = time.monotonic()
+    usage = guild_usage.setdefault(guild_id, deque())
+    while usage and usage[0][0] <= now - GUILD_WINDOW:
+        usage.popleft()
+    if sum(n for _, n in usage) + size > GUILD_BYTES_PER_HOUR:
+        return False
+    usage.append((now, size))
+    return True
+
+async def _convert(api_key, attachment, data, mime):
+    if is_text(attachment, mime):
+        text = data.decode("utf-8", errors="replace")
+        if len(text) > MAX_TEXT_CHARS:
+            text = text[:MAX_TEXT_CHARS] + "\n（以下省略）"
+        return types.Part.from_text(text=f"[添付ファイル: {attachment.filename}]\n{text}"), None
+    uri = await uploader.upload(api_key, data, mime, attachment.filename)
+    expires = time.monotonic() + UPLOAD_TTL
+    upload_expires[uri] = expires
+    return types.Part.from_uri(file_uri=uri, mime_type=mime), expires
+
+async def _load(api_key, attachment, mime):
+    digest = attachment_hashes.get(attachment.id)
+    if digest is not None and (part := _cached_part(digest)) is not None:
+        return digest, part
+    async with get_download_semaphore():
+        data = await attachment.read()
+    digest = hashlib.sha256(data).hexdigest()
+    _remember(attachment_hashes, attachment.id, digest)
+    part = _cached_part(digest)
+    if part is None:
+        part, expires = await _convert(api_key, attachment, data, mime)
+        _remember(parts_cache, digest, {"part": part, "expires": expires})
+    return digest, part
+
+# メッセージの添付ファイルを並行して読み込み、(Partのリスト, 読み込まなかったファイルと理由のリスト) を返す
+async def ingest(api_key, guild_id, attachments):
+    accepted, skipped = [], []
+    message_bytes = 0
+    for attachment in attachments:
+        if not is_supported(attachment):
+            skipped.append((attachment.filename, "対応していない形式"))
+        elif attachment.size > MAX_FILE_BYTES:
+            skipped.append((attachment.filename, "ファイルが大きすぎます"))
+        elif message_bytes + attachment.size > MAX_MESSAGE_BYTES:
+            skipped.append((attachment.filename, "メッセージあたりの上限を超えました"))
+        elif attachment.id not in attachment_hashes and not _reserve_guild_bytes(guild_id, attachment.size):
+            skipped.append((attachment.filename, "サーバーの読み込み上限に達しました"))
+        else:
+            message_bytes += attachment.size
+            accepted.append(attachment)
+
+    results = await asyncio.gather(
+        *(_load(api_key, a, mime_type_of(a)) for a in accepted), return_exceptions=True
+    )
+    parts, seen = [], set()
+    for attachment, result in zip(accepted, results):
+        if isinstance(result, Exception):
+            print(f"[attachments] 読み込みエラー: {attachment.filename}: {result}")
+            skipped.append((attachment.filename, "読み込みに失敗しました"))
+            continue
+        digest, part = result
+        if digest not in seen:  # 同じメッセージ内の重複は1つにまとめる
+            seen.add(digest)
+            parts.append(part)
+    return parts, skipped
+
+# 履歴を保存するときの表記（アップロードしたファイルは期限切れになるため名前だけ残す）
+def describe_part(part):
+    file_data = getattr(part, "file_data", None)
+    if file_data is not None:
+        return f"[添付ファイル: {file_data.mime_type}]"
+    inline_data = getattr(part, "inline_data", None)
+    if inline_data is not None:
+        return f"[添付ファイル: {inline_data.mime_type}]"
+    return str(part)
+
+# 期限切れ（期限が分からないものを含む）のアップロードの参照か
+def is_expired(part, now=None):
+    file_data = getattr(part, "file_data", None)
+    if file_data is None:
+        return False
+    return upload_expires.get(file_data.file_uri, 0) <= (time.monotonic() if now is None else now)
+
+# 期限切れのアップロードの参照を表記に置き換えた履歴（置き換えるものが無ければNone）
+# 期限切れのファイルを履歴に残すと以降の送信が全て失敗するため、送信前に呼ぶ。期限内のファイルはそのまま見せる
+def strip_expired_uploads(history):
+    now = time.monotonic()
+    for uri in [uri for uri, expires in upload_expires.items() if expires <= now]:
+        del upload_expires[uri]  # 期限の分からない参照も期限切れとして扱うので消してよい
+    if not any(is_expired(part, now) for content in history for part in content.parts or []):
+        return None
+    return [
+        types.Content(
+            role=content.role,
+            parts=[types.Part(text=describe_part(part)) if is_expired(part, now) else part for part in content.parts or []]
+        )
+        for content in history
+    ]
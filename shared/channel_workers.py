@@ -0,0 +1,86 @@
+import asyncio
+
+# チャンネルごとに1つの処理タスク（ワーカー）と上限付きキューを持たせ、そのチャンネルの処理を順番に行う
+# ワーカーは最初のメッセージで起動し、一定時間何も来なければ自動で終了する
+QUEUE_SIZE = 100  # チャンネルごとのキューの上限（溢れたら受け付けない）
+IDLE_TIMEOUT = 300.0  # この時間メッセージが無ければワーカーを終了（秒）
+MAX_INFLIGHT = 8  # bot全体で同時に行うGemini呼び出しの上限
+workers = {}  # (guild_id, channel_id) -> ChannelWorker
+inflight_semaphore = None
+stats = {"started": 0, "stopped": 0, "rejected": 0}
+RUNTIME_STATE = ("workers", "inflight_semaphore", "stats")  # 再読み込みで引き継ぐ
+
+def get_inflight_semaphore():
+    global inflight_semaphore
+    if inflight_semaphore is None:
+        inflight_semaphore = asyncio.Semaphore(MAX_INFLIGHT)
+    return inflight_semaphore
+
+class ChannelWorker:
+    def __init__(self, key, handler):
+        self.key = key
+        self.handler = handler  # await handler(worker, [event, ...])
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        self.busy = False  # handler を実行中か
+        self.responding = False  # Geminiの応答を待っているか（handler が設定する）
+        self.responded_at = 0.0  # 最後に応答を終えた時刻（perf_counter）
+        self.task = asyncio.create_task(self._run())
+
+    # 既にキューにあるイベントを待たずに全て取り出す
+    def drain(self):
+        events = []
+        while not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        return events
+
+    # timeout 秒以内に届いた次のイベント（届かなければNone）
+    async def next_event(self, timeout):
+        if timeout <= 0:
+            return self.queue.get_nowait() if not self.queue.empty() else None
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _run(self):
+        while True:
+            event = await self.next_event(IDLE_TIMEOUT)
+            if event is None:
+                # 待っている間に何も来なければ終了（ここで await しないので取りこぼしは無い）
+                if self.queue.empty():
+                    if workers.get(self.key) is self:
+                        del workers[self.key]
+                    stats["stopped"] += 1
+                    return
+                continue
+            self.busy = True
+            try:
+                await self.handler(self, [event] + self.drain())
+            except Exception as e:
+                print(f"[channel_workers] 処理エラー {self.key}: {e}")
+            finally:
+                self.busy = False
+
+# イベントをチャンネルのワーカーに渡す（キューが一杯ならFalse）
+def submit(guild_id, channel_id, event, handler):
+    key = (guild_id, channel_id)
+    worker = workers.get(key)
+    if worker is None or worker.task.done():
+        worker = ChannelWorker(key, handler)
+        workers[key] = worker
+        stats["started"] += 1
+    try:
+        worker.queue.put_nowait(event)
+    except asyncio.QueueFull:
+        stats["rejected"] += 1
+        return False
+    return True
+
+def get_worker(guild_id, channel_id):
+    return workers.get((guild_id, channel_id))
+
+def queued_events():
+    return sum(worker.queue.qsize() for worker in workers.values())
+
+def busy_workers():
+    return [worker for worker in workers.values() if worker.busy]
@@ -0,0 +1,187 @@
+import os
+import json
+import gzip
+import time
+import hashlib
+import storage
+import shared_state
+
+# 保存チャットの形式
+# v1: 保存ごとに history_{名前}.json（全履歴）・config_{名前}.txt・readme_{名前}.txt を書き出す
+# v2: 履歴を数ターンずつの塊に分け、gzip圧縮したJSONLを内容のハッシュ名でギルド共通の blobs に置く（追記のみ）
+#     保存ディレクトリには塊と設定のハッシュを並べた目録（archive.json）だけを書くため、
+#     同じ会話を何度保存しても共通部分と設定は1つのファイルを共有する
+FORMAT_VERSION = 2
+MANIFEST_FILE = "archive.json"
+BLOB_DIR = ".blobs"  # ギルドディレクトリ直下（"." 始まりのため保存チャットとしては扱わない）
+CHUNK_AVERAGE = 16  # 塊の区切りの目安（ターン数）。区切りは内容で決めるので、先頭が削られても後ろの塊は一致する
+CHUNK_MIN = 4
+CHUNK_MAX = 64
+COMPRESS_LEVEL = 6
+GC_GRACE = 60 * 60  # 参照されていないblobでも、この時間内に作られたものは消さない（書きかけの一時ファイルなど）
+
+def manifest_path(save_path):
+    return os.path.join(save_path, MANIFEST_FILE)
+
+def blob_path(guild_dir, digest):
+    return os.path.join(guild_dir, BLOB_DIR, digest[:2], f"{digest}.gz")
+
+# blobの書き込み（共有ロック）と削除（排他ロック）を分けるロック
+def blob_lock_path(guild_dir):
+    return os.path.join(guild_dir, BLOB_DIR)
+
+# 保存チャットとして扱う名前か（"." 始まりの管理用ディレクトリや、他のディレクトリを指すパスは除く）
+def is_save_name(name):
+    return bool(name) and not name.startswith(".") and os.path.basename(name) == name
+
+def is_v2(save_path):
+    return os.path.exists(manifest_path(save_path))
+
+# 内容のハッシュで保存（既にあれば書かない）。ハッシュを返す
+def _put_blob(guild_dir, data):
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(guild_dir, digest)
+    if not os.path.exists(path):
+        shared_state.atomic_write_bytes(path, gzip.compress(data, COMPRESS_LEVEL, mtime=0))
+    return digest
+
+# 1ターン1行のJSONLを、内容で決まる位置で塊に分ける
+def _split_chunks(lines):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        mark = int.from_bytes(hashlib.sha256(line).digest()[:4], "big")
+        if (len(chunk) >= CHUNK_MIN and mark % CHUNK_AVERAGE == 0) or len(chunk) >= CHUNK_MAX:
+            yield b"".join(chunk)
+            chunk = []
+    if chunk:
+        yield b"".join(chunk)
+
+# v2形式で保存し、保存ディレクトリ（目録＋参照するblob）のサイズを返す
+# history_json は1回だけ順に読む（ジェネレーターでもよい）
+def write_save_sync(guild_dir, name, created_at, history_json, config_text, description):
+    turns = 0
+
+    def lines():
+        nonlocal turns
+        for turn in history_json:
+            turns += 1
+            yield json.dumps(turn, ensure_ascii=False, separators=(',', ':')).encode("utf-8") + b"\n"
+
+    # 既存のblobを使い回す場合もあるため、目録を書き終えるまで削除（collect_garbage_sync）を待たせる
+    with shared_state.file_lock(blob_lock_path(guild_dir), shared=True):
+        chunks = [_put_blob(guild_dir, chunk) for chunk in _split_chunks(lines())]
+        config = _put_blob(guild_dir, config_text.encode("utf-8")) if config_text is not None else None
+        manifest = {
+            "format": FORMAT_VERSION,
+            "name": name,
+            "created_at": created_at,
+            "turns": turns,
+            "description": description,
+            "config": config,
+            "chunks": chunks,
+        }
+        shared_state.atomic_write_json(manifest_path(os.path.join(guild_dir, name)), manifest)
+    return save_size_sync(guild_dir, name, manifest)
+
+def read_manifest_sync(save_path):
+    return storage.read_json_sync(manifest_path(save_path))
+
+def _blob_digests(manifest):
+    return manifest["chunks"] + ([manifest["config"]] if manifest.get("config") else [])
+
+# 保存の実サイズ（v2は目録と参照しているblobの合計。他の保存と共有している分も含む）
+def save_size_sync(guild_dir, name, manifest=None):
+    save_path = os.path.join(guild_dir, name)
+    size = sum(file_size for _, _, file_size in storage.walk_files_sync(save_path))
+    if manifest is None and is_v2(save_path):
+        manifest = read_manifest_sync(save_path)
+    if manifest is not None:
+        for digest in set(_blob_digests(manifest)):
+            path = blob_path(guild_dir, digest)
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+    return size
+
+# 履歴を1ターンずつ読み出す（v2は塊ごとに展開するので全体をメモリに載せない）
+def iter_history_sync(guild_dir, name):
+    save_path = os.path.join(guild_dir, name)
+    if not is_v2(save_path):
+        yield from storage.read_json_sync(os.path.join(save_path, f"history_{name}.json"))
+        return
+    for digest in read_manifest_sync(save_path)["chunks"]:
+        with gzip.open(blob_path(guild_dir, digest), "rt", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+# 保存した設定（無ければ空文字列）
+def read_config_sync(guild_dir, name):
+    save_path = os.path.join(guild_dir, name)
+    if is_v2(save_path):
+        digest = read_manifest_sync(save_path).get("config")
+        if not digest:
+            return ""
+        with gzip.open(blob_path(guild_dir, digest), "rb") as f:
+            return f.read().decode("utf-8")
+    config_path = os.path.join(save_path, f"config_{name}.txt")
+    return storage.read_text_sync(config_path) if os.path.exists(config_path) else ""
+
+# 保存が読める状態か（v1は履歴ファイル、v2は目録があるか）
+def exists_sync(guild_dir, name):
+    save_path = os.path.join(guild_dir, name)
+    return is_v2(save_path) or os.path.exists(os.path.join(save_path, f"history_{name}.json"))
+
+# 保存日時（v2は目録に記録した日時。v1は保存ディレクトリの更新日時）
+def created_at_sync(guild_dir, name):
+    save_path = os.path.join(guild_dir, name)
+    if is_v2(save_path):
+        created_at = read_manifest_sync(save_path).get("created_at")
+        if created_at:
+            return created_at
+    return time.strftime("%Y%m%d_%H%M%S", time.localtime(os.path.getmtime(save_path)))
+
+# 目録用の情報 (ターン数, 説明) を取得
+def describe_sync(guild_dir, name, default_description):
+    save_path = os.path.join(guild_dir, name)
+    if is_v2(save_path):
+        manifest = read_manifest_sync(save_path)
+        return manifest["turns"], manifest.get("description") or default_description
+    history_path = os.path.join(save_path, f"history_{name}.json")
+    turns = len(storage.read_json_sync(history_path)) if os.path.exists(history_path) else 0
+    readme_path = os.path.join(save_path, f"readme_{name}.txt")
+    description = storage.read_text_sync(readme_path).strip() if os.path.exists(readme_path) else default_description
+    return turns, description
+
+# v1の保存をv2に変換する（変換した場合True）。remove_old=True なら元のファイルを消す
+def migrate_save_sync(guild_dir, name, default_description, remove_old=True):
+    save_path = os.path.join(guild_dir, name)
+    history_path = os.path.join(save_path, f"history_{name}.json")
+    if is_v2(save_path) or not os.path.exists(history_path):
+        return False
+    turns, description = describe_sync(guild_dir, name, default_description)
+    config_path = os.path.join(save_path, f"config_{name}.txt")
+    config_text = storage.read_text_sync(config_path) if os.path.exists(config_path) else None
+    created_at = created_at_sync(guild_dir, name)
+    write_save_sync(guild_dir, name, created_at, list(iter_history_sync(guild_dir, name)), config_text, description)
+    if remove_old:
+        for old in (history_path, config_path, os.path.join(save_path, f"readme_{name}.txt")):
+            storage.remove_sync(old)
+    return True
+
+# どの保存からも参照されていないblobを削除し、削除した数を返す
+# 保存中（共有ロック）は待つので、bot の起動中に実行してもよい
+def collect_garbage_sync(guild_dir):
+    with shared_state.file_lock(blob_lock_path(guild_dir)):
+        referenced = set()
+        for name in storage.list_subdirs_sync(guild_dir):
+            save_path = os.path.join(guild_dir, name)
+            if is_save_name(name) and is_v2(save_path):
+                referenced.update(_blob_digests(read_manifest_sync(save_path)))
+        removed = 0
+        cutoff = time.time() - GC_GRACE
+        for full_path, relative_path, _ in storage.walk_files_sync(os.path.join(guild_dir, BLOB_DIR)):
+            digest = os.path.basename(relative_path).split(".")[0]
+            if digest not in referenced and os.path.getmtime(full_path) < cutoff:
+                storage.remove_sync(full_path)
+                removed += 1
+    return removed
@@ -0,0 +1,110 @@
+import os
+import json
+import sqlite3
+import storage
+import chat_archive
+
+# ギルドごとの保存チャット目録（SQLite）
+CATALOG_FILE = "catalog.sqlite3"
+PAGE_SIZE = 15  # 1ページあたりの表示件数
+DESCRIPTION_PREVIEW = 80  # 一覧に表示する説明の最大文字数
+SORT_ORDERS = {
+    "new": "created_at DESC",
+    "old": "created_at ASC",
+    "name": "name ASC",
+    "size": "size DESC",
+    "turns": "turns DESC",
+}
+
+def catalog_path(guild_dir):
+    return os.path.join(guild_dir, CATALOG_FILE)
+
+# 既存の保存ディレクトリから目録の1行分を作成（v1・v2のどちらの形式も読む）
+def _scan_entry(guild_dir, name):
+    try:
+        size = chat_archive.save_size_sync(guild_dir, name)
+        turns, description = chat_archive.describe_sync(guild_dir, name, "説明がありません。")
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"[chat_catalog] 履歴の読み込みエラー: {name}: {e}")
+        size, turns, description = 0, 0, "説明がありません。"
+    created_at = chat_archive.created_at_sync(guild_dir, name)
+    return name, created_at, size, turns, description
+
+# 目録に接続（初回は既存ディレクトリから作成）
+def _connect(guild_dir):
+    os.makedirs(guild_dir, exist_ok=True)
+    path = catalog_path(guild_dir)
+    is_new = not os.path.exists(path)
+    conn = sqlite3.connect(path, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS saves ("
+        "name TEXT PRIMARY KEY, created_at TEXT, size INTEGER, turns INTEGER, description TEXT)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS saves_created ON saves(created_at)")
+    if is_new:
+        rows = [
+            _scan_entry(guild_dir, name)
+            for name in storage.list_subdirs_sync(guild_dir) if chat_archive.is_save_name(name)
+        ]
+        conn.executemany("INSERT OR REPLACE INTO saves VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+    return conn
+
+def add_entry_sync(guild_dir, name, created_at, size, turns, description):
+    conn = _connect(guild_dir)
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO saves VALUES (?, ?, ?, ?, ?)",
+                         (name, created_at, size, turns, description))
+    finally:
+        conn.close()
+
+# 保存ディレクトリを走査して目録に登録
+def index_save_sync(guild_dir, name):
+    add_entry_sync(guild_dir, *_scan_entry(guild_dir, name))
+
+def get_entry_sync(guild_dir, name):
+    if not os.path.isdir(guild_dir):
+        return None
+    conn = _connect(guild_dir)
+    try:
+        row = conn.execute("SELECT name, created_at, size, turns, description FROM saves WHERE name = ?",
+                           (name,)).fetchone()
+    finally:
+        conn.close()
+    return _row_to_dict(row) if row else None
+
+# 並び替え・絞り込み・ページ分割した一覧を取得
+def list_entries_sync(guild_dir, sort="new", keyword=None, page=1, page_size=PAGE_SIZE):
+    if not os.path.isdir(guild_dir):
+        return [], 0
+    where, params = "", []
+    if keyword:
+        where = "WHERE name LIKE ? OR description LIKE ?"
+        params = [f"%{keyword}%", f"%{keyword}%"]
+    conn = _connect(guild_dir)
+    try:
+        total = conn.execute(f"SELECT COUNT(*) FROM saves {where}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT name, created_at, size, turns, description FROM saves {where} "
+            f"ORDER BY {SORT_ORDERS.get(sort, SORT_ORDERS['new'])} LIMIT ? OFFSET ?",
+            params + [page_size, (max(page, 1) - 1) * page_size]
+        ).fetchall()
+    finally:
+        conn.close()
+    return [_row_to_dict(row) for row in rows], total
+
+def _row_to_dict(row):
+    name, created_at, size, turns, description = row
+    return {"name": name, "created_at": created_at, "size": size, "turns": turns, "description": description}
+
+# ===== 非同期API =====
+
+async def index_save(guild_dir, name):
+    await storage.run_io(index_save_sync, guild_dir, name)
+
+async def get_entry(guild_dir, name):
+    return await storage.run_io(get_entry_sync, guild_dir, name)
+
+async def list_entries(guild_dir, sort="new", keyword=None, page=1, page_size=PAGE_SIZE):
+    return await storage.run_io(list_entries_sync, guild_dir, sort, keyword, page, page_size)
@@ -0,0 +1,121 @@
+import os
+import zlib
+import asyncio
+import zipfile
+import tempfile
+import discord
+import storage
+
+# ZIP1エントリあたりのヘッダ容量（ローカルヘッダ30 + セントラルディレクトリ46バイト + ファイル名×2）
+ZIP_ENTRY_OVERHEAD = 30 + 46
+ZIP_END_OVERHEAD = 22  # 終端レコード
+SIZE_MARGIN = 64 * 1024  # 添付上限に対する安全マージン
+READ_CHUNK = 1024 * 1024
+EXPORT_STATE_FILE = ".last_export.json"  # 差分エクスポート用の前回時刻
+EXCLUDED_FILES = {EXPORT_STATE_FILE, "catalog.sqlite3", "search.sqlite3", ".blobs.lock"}  # 再生成できるためZIPに含めない
+STORED_SUFFIXES = (".gz",)  # 圧縮済み（v2形式のblob）のため再圧縮せずに格納する
+
+def is_stored(path):
+    return path.endswith(STORED_SUFFIXES)
+
+# zipfileと同じ設定でDeflate圧縮した場合のサイズを計算
+def compressed_size_sync(path):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    size = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_CHUNK):
+            size += len(compressor.compress(chunk))
+    return size + len(compressor.flush())
+
+# 実際の圧縮後サイズで上限までファイルを詰めてパートに分割
+def plan_parts_sync(folder_path, max_size, since=None):
+    parts = []
+    current_part = []
+    current_size = ZIP_END_OVERHEAD
+    limit = max_size - SIZE_MARGIN
+
+    for full_path, relative_path, _ in sorted(storage.walk_files_sync(folder_path), key=lambda f: f[1]):
+        if os.path.basename(relative_path) in EXCLUDED_FILES:
+            continue
+        if since is not None and os.path.getmtime(full_path) <= since:
+            continue
+        data_size = os.path.getsize(full_path) if is_stored(full_path) else compressed_size_sync(full_path)
+        entry_size = data_size + ZIP_ENTRY_OVERHEAD + 2 * len(relative_path.encode())
+        if entry_size > limit:
+            print(f"[chat_export] 上限を超えるファイルです: {relative_path} ({entry_size} bytes)")
+
+        # 新しい part を作成
+        if current_size + entry_size > limit and current_part:
+            parts.append(current_part)
+            current_part = []
+            current_size = ZIP_END_OVERHEAD
+
+        current_part.append((full_path, relative_path))
+        current_size += entry_size
+
+    if current_part:
+        parts.append(current_part)
+    return parts
+
+# パートを一時ファイルへ書き出す（メモリに展開しない）
+def build_part_sync(file_group):
+    fd, zip_path = tempfile.mkstemp(suffix=".zip")
+    with os.fdopen(fd, "wb") as f, zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for full_path, relative_path in file_group:
+            compress_type = zipfile.ZIP_STORED if is_stored(full_path) else zipfile.ZIP_DEFLATED
+            zipf.write(full_path, arcname=relative_path, compress_type=compress_type)
+    return zip_path
+
+def load_last_export_sync(folder_path):
+    path = os.path.join(folder_path, EXPORT_STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    return storage.read_json_sync(path).get("exported_at")
+
+def save_last_export_sync(folder_path, exported_at):
+    storage.write_json_sync(os.path.join(folder_path, EXPORT_STATE_FILE), {"exported_at": exported_at})
+
+# 一時ファイルを削除しながらキューを空にする
+async def _drain(queue):
+    while not queue.empty():
+        item = queue.get_nowait()
+        if item is not None:
+            await storage.remove(item[1])
+
+# 次のパートを作りながら前のパートを送信する
+async def export_parts(channel, guild_id, parts):
+    queue = asyncio.Queue(maxsize=1)
+
+    async def produce():
+        for i, file_group in enumerate(parts, 1):
+            await queue.put((i, await storage.run_io(build_part_sync, file_group)))
+        await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (item := await queue.get()) is not None:
+            i, zip_path = item
+            try:
+                await channel.send(
+                    content=f"!パート {i}/{len(parts)} を送信します。",
+                    file=discord.File(zip_path, f"chat_backup_{guild_id}_part{i}.zip")
+                )
+            finally:
+                await storage.remove(zip_path)
+        await producer
+    finally:
+        # 送信失敗時は作成を止め、残った一時ファイルを片付ける
+        if not producer.done():
+            producer.cancel()
+            await _drain(queue)
+            await asyncio.gather(producer, return_exceptions=True)
+        await _drain(queue)
+
+# エクスポート対象をパートに分割（incremental=Trueなら前回以降の分のみ）
+async def plan_export(folder_path, max_size, incremental=False):
+    since = await storage.run_io(load_last_export_sync, folder_path) if incremental else None
+    return await storage.run_io(plan_parts_sync, folder_path, max_size, since)
+
+# エクスポート完了時刻を記録
+async def mark_exported(folder_path, exported_at):
+    await storage.run_io(save_last_export_sync, folder_path, exported_at)
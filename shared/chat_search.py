@@ -0,0 +1,231 @@
+import os
+import re
+import math
+import time
+import hashlib
+import sqlite3
+import unicodedata
+import storage
+import chat_archive
+
+# 保存チャットの全文検索（ギルドごとのSQLite転置索引）
+# 日本語は単語に区切れないため、文字2-gramを索引にして候補を絞り、本文に検索語が含まれるか確かめてから順位付けする
+# 保存ごとではなくターンの内容ごとに1件として登録するので、同じ会話を何度保存しても索引は増えない
+INDEX_FILE = "search.sqlite3"
+GRAM_SIZE = 2
+MAX_RESULTS = 10  # 表示する件数
+MAX_CANDIDATES = 5000  # 本文を確かめる候補の上限
+SNIPPET_CHARS = 80  # スニペットの長さ（文字数）
+SAVES_PER_RESULT = 3  # 1件の結果に並べる保存名の数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def index_path(guild_dir):
+    return os.path.join(guild_dir, INDEX_FILE)
+
+def normalize(text):
+    return unicodedata.normalize("NFKC", text).lower()
+
+# 文字n-gramの集合（空白をまたがない。n文字未満の語はそのまま）
+def grams(text):
+    result = set()
+    for word in normalize(text).split():
+        if len(word) < GRAM_SIZE:
+            continue
+        result.update(word[i:i + GRAM_SIZE] for i in range(len(word) - GRAM_SIZE + 1))
+    return result
+
+# 1ターン分の本文（添付ファイルなどの非テキストは除く）
+def turn_text(turn):
+    texts = []
+    for part in turn["parts"]:
+        if isinstance(part, str):
+            texts.append(part)
+        elif isinstance(part, dict) and part.get("text"):
+            texts.append(part["text"])
+    return "\n".join(texts)
+
+def _connect(guild_dir):
+    os.makedirs(guild_dir, exist_ok=True)
+    conn = sqlite3.connect(index_path(guild_dir), timeout=30)
+    conn.executescript(
+        "CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, hash TEXT UNIQUE, role TEXT, text TEXT, length INTEGER);"
+        "CREATE TABLE IF NOT EXISTS postings (gram TEXT, doc INTEGER, PRIMARY KEY (gram, doc)) WITHOUT ROWID;"
+        "CREATE TABLE IF NOT EXISTS occurrences (save TEXT, turn INTEGER, doc INTEGER, PRIMARY KEY (save, turn));"
+        "CREATE INDEX IF NOT EXISTS occurrences_doc ON occurrences(doc);"
+        "CREATE TABLE IF NOT EXISTS saves (name TEXT PRIMARY KEY, created_at TEXT);"
+    )
+    return conn
+
+# 1つの保存を索引に追加（トランザクション内で呼ぶ）
+def _add_save(conn, name, created_at, history_json):
+    conn.execute("DELETE FROM occurrences WHERE save = ?", (name,))
+    for turn_no, turn in enumerate(history_json):
+        text = turn_text(turn)
+        if not text.strip():
+            continue
+        digest = hashlib.sha256(f"{turn['role']}\n{text}".encode("utf-8")).hexdigest()
+        row = conn.execute("SELECT id FROM docs WHERE hash = ?", (digest,)).fetchone()
+        if row is None:
+            doc = conn.execute(
+                "INSERT INTO docs (hash, role, text, length) VALUES (?, ?, ?, ?)",
+                (digest, turn["role"], text, len(text))
+            ).lastrowid
+            conn.executemany("INSERT OR IGNORE INTO postings VALUES (?, ?)", ((gram, doc) for gram in grams(text)))
+        else:
+            doc = row[0]
+        conn.execute("INSERT OR REPLACE INTO occurrences VALUES (?, ?, ?)", (name, turn_no, doc))
+    conn.execute("INSERT OR REPLACE INTO saves VALUES (?, ?)", (name, created_at))
+
+# 削除された保存を索引から外し、どこからも参照されなくなったターンを消す
+def _remove_saves(conn, names):
+    for name in names:
+        conn.execute("DELETE FROM occurrences WHERE save = ?", (name,))
+        conn.execute("DELETE FROM saves WHERE name = ?", (name,))
+    orphans = [row[0] for row in conn.execute("SELECT id FROM docs WHERE id NOT IN (SELECT doc FROM occurrences)")]
+    for doc in orphans:
+        conn.execute("DELETE FROM postings WHERE doc = ?", (doc,))
+        conn.execute("DELETE FROM docs WHERE id = ?", (doc,))
+
+# 保存した直後に呼ぶ（履歴は保存したものをそのまま渡す）
+def index_save_sync(guild_dir, name, created_at, history_json):
+    conn = _connect(guild_dir)
+    try:
+        with conn:
+            _add_save(conn, name, created_at, history_json)
+    finally:
+        conn.close()
+
+# ディレクトリと索引の差分だけを反映（未登録の保存を追加、消えた保存を削除）
+def sync_sync(guild_dir):
+    if not os.path.isdir(guild_dir):
+        return
+    on_disk = {name for name in storage.list_subdirs_sync(guild_dir) if chat_archive.is_save_name(name)}
+    conn = _connect(guild_dir)
+    try:
+        indexed = {row[0] for row in conn.execute("SELECT name FROM saves")}
+        for name in sorted(on_disk - indexed):
+            if not chat_archive.exists_sync(guild_dir, name):
+                continue
+            try:
+                history_json = list(chat_archive.iter_history_sync(guild_dir, name))
+                with conn:
+                    _add_save(conn, name, chat_archive.created_at_sync(guild_dir, name), history_json)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[chat_search] 索引の作成エラー: {name}: {e}")
+        if indexed - on_disk:
+            with conn:
+                _remove_saves(conn, indexed - on_disk)
+    finally:
+        conn.close()
+
+def _snippet(text, terms):
+    flat = " ".join(text.split())
+    for source in (flat, normalize(flat)):
+        match = re.search("|".join(re.escape(term) for term in terms), source, re.IGNORECASE)
+        if match:
+            break
+    else:
+        return flat[:SNIPPET_CHARS]
+    start = max(0, match.start() - (SNIPPET_CHARS - len(match.group())) // 2)
+    end = min(len(source), start + SNIPPET_CHARS)
+    start = max(0, end - SNIPPET_CHARS)
+    return (
+        ("…" if start > 0 else "")
+        + f"{source[start:match.start()]}**{match.group()}**{source[match.end():end]}"
+        + ("…" if end < len(source) else "")
+    )
+
+def _fetch_docs(conn, doc_ids):
+    docs = {}
+    doc_ids = list(doc_ids)
+    for i in range(0, len(doc_ids), 500):
+        batch = doc_ids[i:i + 500]
+        rows = conn.execute(
+            f"SELECT id, role, text, length FROM docs WHERE id IN ({','.join('?' * len(batch))})", batch
+        )
+        docs.update((doc, (role, text, length)) for doc, role, text, length in rows)
+    return docs
+
+# 検索して (上位の結果, 一致したターン数) を返す。結果は新しい保存から順に保存名を並べる
+def search_sync(guild_dir, query, limit=MAX_RESULTS):
+    terms = [term for term in normalize(query).split() if term]
+    if not terms or not os.path.isdir(guild_dir):
+        return [], 0
+    sync_sync(guild_dir)
+    conn = _connect(guild_dir)
+    try:
+        query_grams = set().union(*(grams(term) for term in terms))
+        if query_grams:
+            # 全てのn-gramを含むターンが候補
+            placeholders = ",".join("?" * len(query_grams))
+            candidates = [row[0] for row in conn.execute(
+                f"SELECT doc FROM postings WHERE gram IN ({placeholders}) GROUP BY doc HAVING COUNT(*) = ? LIMIT ?",
+                [*query_grams, len(query_grams), MAX_CANDIDATES]
+            )]
+            gram_df = dict(conn.execute(
+                f"SELECT gram, COUNT(*) FROM postings WHERE gram IN ({placeholders}) GROUP BY gram", list(query_grams)
+            ))
+        else:
+            # 1文字だけの検索は索引を使えないので本文を探す
+            candidates = [row[0] for row in conn.execute(
+                "SELECT id FROM docs WHERE instr(lower(text), ?) > 0 LIMIT ?", (terms[0], MAX_CANDIDATES)
+            )]
+            gram_df = {}
+        total_docs, average_length = conn.execute("SELECT COUNT(*), AVG(length) FROM docs").fetchone()
+        docs = _fetch_docs(conn, candidates)
+
+        # 語の出現ターン数は、その語のn-gramのうち最も少ないものの出現ターン数で見積もる
+        idfs = []
+        for term in terms:
+            df = min((gram_df.get(gram, 0) for gram in grams(term)), default=len(docs)) or 1
+            idfs.append(math.log(1 + (total_docs - df + 0.5) / (df + 0.5)))
+
+        # 本文に検索語が全て含まれるものをBM25で順位付け
+        scored = []
+        for doc, (role, text, length) in docs.items():
+            normalized = normalize(text)
+            counts = [normalized.count(term) for term in terms]
+            if not all(counts):
+                continue
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / (average_length or 1))
+            score = sum(idf * count * (BM25_K1 + 1) / (count + norm) for idf, count in zip(idfs, counts))
+            scored.append((score, doc, role, text))
+        scored.sort(key=lambda item: item[0], reverse=True)
+
+        results = []
+        for score, doc, role, text in scored[:limit]:
+            saves = conn.execute(
+                "SELECT o.save, o.turn FROM occurrences o JOIN saves s ON s.name = o.save "
+                "WHERE o.doc = ? ORDER BY s.created_at DESC, o.save DESC",
+                (doc,)
+            ).fetchall()
+            results.append({
+                "score": score,
+                "role": role,
+                "snippet": _snippet(text, terms),
+                "saves": saves,
+            })
+    finally:
+        conn.close()
+    return results, len(scored)
+
+# 検索結果を表示用の文字列にする
+def format_results(query, results, total, elapsed):
+    if not results:
+        return f"!「{query}」に一致する保存チャットはありません。（{elapsed * 1000:.0f}ms）"
+    lines = [f"!「{query}」の検索結果（{total}件中 上位{len(results)}件, {elapsed * 1000:.0f}ms）"]
+    for i, result in enumerate(results, 1):
+        saves = [f"`{save}` #{turn}" for save, turn in result["saves"][:SAVES_PER_RESULT]]
+        if len(result["saves"]) > SAVES_PER_RESULT:
+            saves.append(f"他{len(result['saves']) - SAVES_PER_RESULT}件")
+        lines.append(f"{i}. [{result['role']}] {', '.join(saves)}\n　{result['snippet']}")
+    return "\n".join(lines)
+
+# ===== 非同期API =====
+
+# 検索して表示用の文字列を返す
+async def search(guild_dir, query, limit=MAX_RESULTS):
+    start = time.perf_counter()
+    results, total = await storage.run_io(search_sync, guild_dir, query, limit)
+    return format_results(query, results, total, time.perf_counter() - start)
@@ -0,0 +1,69 @@
+import os
+import json
+import asyncio
+import hashlib
+import storage
+import shared_state
+
+# スラッシュコマンドの同期を、登録内容が変わったスコープだけに絞る
+# スコープ（グローバル・ギルド）ごとに前回同期したコマンド定義のハッシュを保存する
+# 強制的に同期し直したい場合は保存ファイルを削除する
+SYNC_DIR = "/app/shared/command_sync"
+SYNC_CONCURRENCY = 2  # 同時に行う同期の数（Discordのレート制限対策）
+
+def state_path(bot_id):
+    return os.path.join(SYNC_DIR, f"{bot_id}.json")
+
+def _load_state_sync(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        return storage.read_json_sync(path)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"[command_sync] 同期状態を読めませんでした: {e}")
+        return {}
+
+# コマンドツリーのうち、指定スコープに登録されている定義のハッシュ
+def command_hash(tree, guild=None):
+    payload = []
+    for command in tree.get_commands(guild=guild):
+        try:
+            payload.append(command.to_dict(tree))
+        except TypeError:
+            payload.append(command.to_dict())  # 古いdiscord.pyは引数なし
+    payload.sort(key=lambda c: (c.get("type", 1), c["name"]))
+    text = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# 変更のあったスコープだけ tree.sync する。同期したスコープ数を返す
+# シャードを分けている場合、グローバルコマンドは1つのプロセス（sync_global=True）だけが同期する
+async def sync_commands(tree, client, sync_global=True):
+    path = state_path(client.user.id)
+    synced = await storage.run_io(_load_state_sync, path)
+    updated = {}
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+    async def sync_scope(guild):
+        key = "global" if guild is None else str(guild.id)
+        name = "グローバル" if guild is None else guild.name
+        digest = command_hash(tree, guild)
+        if synced.get(key) == digest:
+            return False
+        async with semaphore:
+            try:
+                await tree.sync(guild=guild)
+            except Exception as e:
+                print(f"[command_sync] {name} への同期に失敗: {e}")
+                return False
+        updated[key] = digest
+        print(f"[command_sync] {name} にコマンドを同期しました")
+        return True
+
+    scopes = ([None] if sync_global else []) + list(client.guilds)
+    results = await asyncio.gather(*(sync_scope(guild) for guild in scopes))
+    count = sum(results)
+    if updated:
+        # 他のシャードが同時に書き込んでも消し合わないよう、読み直してから反映する
+        await storage.run_io(shared_state.update_json_locked, path, lambda data: data.update(updated))
+    print(f"[command_sync] 同期 {count} 件 / 変更なし {len(results) - count} 件")
+    return count
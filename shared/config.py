@@ -1,28 +1,134 @@
-import json
-import os
-from dotenv import load_dotenv
-
-CHANNEL_FILE = "allowed_channels.json"
-allowed_channels_per_guild = {}
-# トークン（.env から読み込み）
-GEMINI_TOKEN = None
-DISCORD_TOKEN = None
-
-def load_env(env_path="/app/.env"):
-    """環境変数を読み込む（GEMINI_TOKEN と DISCORD_TOKEN を取得）"""
-    global GEMINI_TOKEN, DISCORD_TOKEN
-    load_dotenv(env_path)
-    GEMINI_TOKEN = os.getenv("GEMINI_TOKEN")
-    DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
-
-def save_allowed_channels():
-    with open(CHANNEL_FILE, "w") as f:
-        json.dump(allowed_channels_per_guild, f)
-
-def load_allowed_channels():
-    global allowed_channels_per_guild
-    if os.path.exists(CHANNEL_FILE):
-        with open(CHANNEL_FILE, "r") as f:
-            allowed_channels_per_guild = json.load(f)
-    else:
-        allowed_channels_per_guild = {}
+import json
+import os
+from dotenv import load_dotenv
+import shared_state
+
+# 以前の保存先（初回起動時に state_backend へ取り込む）
+CHANNEL_FILE = os.getenv("CHANNEL_FILE", "allowed_channels.json")
+EXPORT_LIMIT_FILE = os.getenv("EXPORT_LIMIT_FILE", "export_limits.json")
+CHANNELS_NAMESPACE = "allowed_channels"
+EXPORT_LIMITS_NAMESPACE = "export_limits"
+backend = None  # state_backend の保存先（use_backend で設定）
+# チャンネルごとのシステム指示の置き場所（シャードを複数のコンテナに分ける場合は ./shared 配下を指定）
+CHAT_CONFIG_DIR = os.getenv("CHAT_CONFIG_DIR", "/app/bot/chat_config")
+allowed_channels_per_guild = {}
+export_limits_per_guild = {}  # ギルドごとのZIP分割サイズ上限（バイト）
+allowed_channel_index = frozenset()  # (guild_id(int), channel_id) の集合。応答可否をO(1)で判定する
+# トークン（.env から読み込み）
+GEMINI_TOKEN = None
+DISCORD_TOKEN = None
+METRICS_HOST = "127.0.0.1"  # メトリクスエンドポイントの待ち受けアドレス
+METRICS_PORT = 9100  # 0 で無効
+SHARD_COUNT = None  # シャード数（None: シャードなし / 0: Discordの推奨数）
+SHARD_IDS = None  # このプロセスが受け持つシャード番号のリスト（None: 全て）
+# 再読み込み直後も応答チャンネル・トークンが空にならないように引き継ぐ
+RUNTIME_STATE = (
+    "allowed_channels_per_guild", "export_limits_per_guild", "allowed_channel_index",
+    "GEMINI_TOKEN", "DISCORD_TOKEN", "METRICS_HOST", "METRICS_PORT", "SHARD_COUNT", "SHARD_IDS", "backend",
+)
+
+def load_env(env_path="/app/.env"):
+    """環境変数を読み込む（GEMINI_TOKEN と DISCORD_TOKEN を取得）"""
+    global GEMINI_TOKEN, DISCORD_TOKEN, METRICS_HOST, METRICS_PORT, SHARD_COUNT, SHARD_IDS
+    load_dotenv(env_path)
+    GEMINI_TOKEN = os.getenv("GEMINI_TOKEN")
+    DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
+    METRICS_HOST = os.getenv("METRICS_HOST", METRICS_HOST)
+    METRICS_PORT = int(os.getenv("METRICS_PORT", METRICS_PORT))
+    # シャード構成（例: SHARD_COUNT=4, SHARD_IDS=0,1 で4分割のうち0と1を受け持つ）
+    shard_count = os.getenv("SHARD_COUNT", "").strip()
+    SHARD_COUNT = int(shard_count) if shard_count else None
+    shard_ids = os.getenv("SHARD_IDS", "").strip()
+    SHARD_IDS = [int(i) for i in shard_ids.split(",") if i.strip()] if shard_ids else None
+    # 受け持つシャードを選ぶ場合は全体のシャード数が必要（discord.py は推奨数との組み合わせを受け付けない）
+    if SHARD_IDS is not None:
+        if not SHARD_COUNT:
+            raise ValueError("SHARD_IDS を指定する場合は SHARD_COUNT に1以上のシャード数を指定してください")
+        if any(i < 0 or i >= SHARD_COUNT for i in SHARD_IDS):
+            raise ValueError(f"SHARD_IDS は 0〜{SHARD_COUNT - 1} の範囲で指定してください: {SHARD_IDS}")
+
+# グローバルな処理（グローバルコマンドの同期など）をこのプロセスが担当するか
+def is_primary_shard():
+    return SHARD_IDS is None or 0 in SHARD_IDS
+
+def chat_config_path(guild_id, channel_id):
+    return f"{CHAT_CONFIG_DIR}/chat_config_{guild_id}/chat_config_{channel_id}.txt"
+
+# allowed_channels_per_guild から判定用の索引を作り直す
+def rebuild_channel_index():
+    global allowed_channel_index
+    allowed_channel_index = frozenset(
+        (int(guild_id), channel_id)
+        for guild_id, channel_ids in allowed_channels_per_guild.items()
+        for channel_id in channel_ids
+    )
+
+def _read_json_locked(path):
+    if not os.path.exists(path):
+        return {}
+    with shared_state.file_lock(path, shared=True):
+        with open(path, "r") as f:
+            return json.load(f)
+
+# 保存先を設定し、以前のJSONファイルがあれば（保存先が空のときだけ）取り込む
+def use_backend(new_backend):
+    global backend
+    backend = new_backend
+    for namespace, path in ((CHANNELS_NAMESPACE, CHANNEL_FILE), (EXPORT_LIMITS_NAMESPACE, EXPORT_LIMIT_FILE)):
+        legacy = _read_json_locked(path)
+        if not legacy:
+            continue
+        def update(data):
+            if data:
+                return False
+            data.update(legacy)
+            return True
+        if backend.update(namespace, update)[1]:
+            print(f"[config] {path} を {namespace} に取り込みました")
+
+def channels_revision():
+    return backend.revision(CHANNELS_NAMESPACE)
+
+def load_allowed_channels():
+    global allowed_channels_per_guild
+    allowed_channels_per_guild = backend.load(CHANNELS_NAMESPACE)
+    rebuild_channel_index()
+
+# 保存先を読み直したうえで追加・削除する（他のシャード・botの変更を上書きしない）
+def _update_allowed_channels(update):
+    global allowed_channels_per_guild
+    allowed_channels_per_guild, changed = backend.update(CHANNELS_NAMESPACE, update)
+    rebuild_channel_index()
+    return changed
+
+def add_allowed_channel(guild_id, channel_id):
+    def update(data):
+        channels = data.setdefault(guild_id, [])
+        if channel_id in channels:
+            return False
+        channels.append(channel_id)
+        return True
+    return _update_allowed_channels(update)
+
+def remove_allowed_channel(guild_id, channel_id):
+    def update(data):
+        channels = data.get(guild_id, [])
+        if channel_id not in channels:
+            return False
+        channels.remove(channel_id)
+        return True
+    return _update_allowed_channels(update)
+
+# ギルドのZIP分割上限を設定（None で既定値に戻す）
+def set_export_limit(guild_id, limit):
+    global export_limits_per_guild
+    def update(data):
+        if limit is None:
+            data.pop(guild_id, None)
+        else:
+            data[guild_id] = limit
+    export_limits_per_guild, _ = backend.update(EXPORT_LIMITS_NAMESPACE, update)
+
+def load_export_limits():
+    global export_limits_per_guild
+    export_limits_per_guild = backend.load(EXPORT_LIMITS_NAMESPACE)
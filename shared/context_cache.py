@@ -0,0 +1,134 @@
+import time
+import asyncio
+import hashlib
+from google.genai import types, errors
+import gemini_client
+import message_buffer
+
+# 長いシステム指示を Gemini のキャッシュ（cached content）に載せ、毎ターンの再送・再課金を避ける
+# キャッシュは指示文のハッシュごとに遅延作成し、期限が近づいたら延長、指示が変わったら削除する
+# 作成できない場合（対応外のモデル・短すぎる指示・APIエラー）は通常どおり system_instruction を送る
+ENABLED = True
+CACHE_TTL = 3600  # キャッシュの有効期間（秒）
+REFRESH_MARGIN = 300  # 残りがこれを切ったら期限を延長（秒）
+MIN_CACHE_TOKENS = 4096  # これより短い指示はキャッシュしない（APIの最小サイズ）
+FAILURE_BACKOFF = 600  # 作成に失敗した指示・モデルを再試行しない時間（秒）
+CACHE_ERROR_CODES = {400, 403, 404}  # キャッシュ参照で失敗したときに作り直す対象
+
+# (api_key, model, 指示のハッシュ) -> {"name": キャッシュ名, "expires": 期限(monotonic), "paths": 使用中の設定ファイル}
+caches = {}
+path_keys = {}  # 設定ファイル -> 現在使っているキャッシュのキー
+failures = {}  # キャッシュのキー -> 再試行可能になる時刻(monotonic)
+cache_locks = {}
+RUNTIME_STATE = ("caches", "path_keys", "failures", "cache_locks")  # 再読み込みで引き継ぐ
+
+class GeminiCacheBackend:
+    async def create(self, api_key, model, inst, ttl):
+        cache = await gemini_client.get_client(api_key).aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(system_instruction=inst, ttl=f"{ttl}s")
+        )
+        return cache.name
+
+    async def extend(self, api_key, name, ttl):
+        await gemini_client.get_client(api_key).aio.caches.update(
+            name=name,
+            config=types.UpdateCachedContentConfig(ttl=f"{ttl}s")
+        )
+
+    async def delete(self, api_key, name):
+        await gemini_client.get_client(api_key).aio.caches.delete(name=name)
+
+# テストではローカルのスタブ（create/extend/delete を持つオブジェクト）に差し替える
+backend = GeminiCacheBackend()
+
+def cache_key(api_key, model, inst):
+    return (api_key, model, hashlib.sha1(inst.encode("utf-8")).hexdigest())
+
+def get_cache_lock(key):
+    return cache_locks.setdefault(key, asyncio.Lock())
+
+def plain_config(inst):
+    return types.GenerateContentConfig(system_instruction=inst)
+
+# キャッシュ参照が原因の失敗か（期限切れ・削除済み・対応外）
+def is_cache_error(error):
+    return isinstance(error, errors.APIError) and error.code in CACHE_ERROR_CODES
+
+async def _delete(api_key, name):
+    try:
+        await backend.delete(api_key, name)
+    except Exception as e:
+        print(f"[context_cache] 削除エラー: {e}")
+
+# 設定ファイルが別のキャッシュに切り替わったら、誰も使わなくなった古いキャッシュを消す
+async def _switch_path(path, key):
+    old_key = path_keys.get(path)
+    if old_key == key:
+        return
+    if key is None:
+        path_keys.pop(path, None)
+    else:
+        path_keys[path] = key
+        caches[key]["paths"].add(path)
+    old = caches.get(old_key)
+    if old is not None:
+        old["paths"].discard(path)
+        if not old["paths"]:
+            del caches[old_key]
+            await _delete(old_key[0], old["name"])
+
+async def _ensure(key, inst):
+    api_key, model, _ = key
+    async with get_cache_lock(key):
+        now = time.monotonic()
+        entry = caches.get(key)
+        if entry is not None and entry["expires"] - now > REFRESH_MARGIN:
+            return entry
+        if entry is not None and entry["expires"] > now:
+            try:
+                await backend.extend(api_key, entry["name"], CACHE_TTL)
+                entry["expires"] = now + CACHE_TTL
+                return entry
+            except Exception as e:
+                print(f"[context_cache] 延長に失敗したため作り直します: {e}")
+        if failures.get(key, 0) > now:
+            return None
+        try:
+            name = await backend.create(api_key, model, inst, CACHE_TTL)
+        except Exception as e:
+            print(f"[context_cache] 作成できませんでした（通常送信に切り替えます）: {e}")
+            failures[key] = now + FAILURE_BACKOFF
+            return None
+        paths = entry["paths"] if entry is not None else set()
+        entry = {"name": name, "expires": now + CACHE_TTL, "paths": paths}
+        caches[key] = entry
+        failures.pop(key, None)
+        return entry
+
+# 送信に使う設定を返す（キャッシュを使える場合は cached_content を指定）
+async def generate_config(api_key, model, path, inst):
+    if not ENABLED or message_buffer.estimate_tokens(inst) < MIN_CACHE_TOKENS:
+        await _switch_path(path, None)
+        return plain_config(inst)
+    key = cache_key(api_key, model, inst)
+    entry = await _ensure(key, inst)
+    if entry is None:
+        await _switch_path(path, None)
+        return plain_config(inst)
+    await _switch_path(path, key)
+    return types.GenerateContentConfig(cached_content=entry["name"])
+
+# キャッシュ参照で失敗した場合に破棄し、しばらく作り直さない
+async def discard(api_key, model, inst):
+    key = cache_key(api_key, model, inst)
+    entry = caches.pop(key, None)
+    failures[key] = time.monotonic() + FAILURE_BACKOFF
+    if entry is not None:
+        for path in entry["paths"]:
+            path_keys.pop(path, None)
+        await _delete(api_key, entry["name"])
+
+# 設定ファイルの変更・削除時に、そのファイルが使っていたキャッシュを手放す
+async def invalidate(path):
+    await _switch_path(path, None)
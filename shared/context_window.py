@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+from google.genai.types import Content, Part
+import gemini_client
+import rate_limiter
+
+# チャット履歴のトークン予算管理
+TOKEN_BUDGET = 32000  # チャンネルごとの履歴トークン上限
+TRIM_TARGET = 0.7  # 上限超過時にこの割合まで削減する
+SUMMARIZE = True  # 削除するターンを要約して残すか
+COUNT_CONCURRENCY = 8  # 数え済みでないターンのトークン数を同時に問い合わせる数
+SUMMARY_PREFIX = "【これまでの会話の要約】"
+SUMMARY_PROMPT = "以下の会話の要点（登場人物、設定、決定事項、未解決の話題）を日本語で簡潔に要約してください。\n\n"
+token_cache = {}  # ターンの指紋 -> トークン数
+pinned_per_ch = {}  # チャンネルごとの固定ターン（指紋の集合）
+RUNTIME_STATE = ("token_cache", "pinned_per_ch")  # 再読み込みで引き継ぐ
+
+# ターン内容のテキスト
+def turn_text(content):
+    return "\n".join(part.text for part in content.parts if getattr(part, "text", None))
+
+# ターンの指紋（役割と内容のハッシュ）
+def fingerprint(content):
+    return hashlib.sha1(f"{content.role}\n{turn_text(content)}".encode()).hexdigest()
+
+# 1ターンのトークン数（キャッシュ付き）
+async def count_turn_tokens(api_key, model, content):
+    key = fingerprint(content)
+    if key not in token_cache:
+        try:
+            response = await gemini_client.get_client(api_key).aio.models.count_tokens(model=model, contents=[content])
+            token_cache[key] = response.total_tokens
+        except Exception as e:
+            print(f"[context_window] トークン数の取得エラー: {e}")
+            return len(turn_text(content)) // 2  # 概算（キャッシュしない）
+    return token_cache[key]
+
+# 複数ターンのトークン数（数え済みでないものはまとめて並行に問い合わせる）
+async def count_turns_tokens(api_key, model, contents):
+    semaphore = asyncio.Semaphore(COUNT_CONCURRENCY)
+
+    async def count(content):
+        async with semaphore:
+            return await count_turn_tokens(api_key, model, content)
+
+    return await asyncio.gather(*(count(content) for content in contents))
+
+# 履歴全体のトークン数（数え済みのターンはキャッシュ、それ以外は概算）
+def estimate_history_tokens(chat):
+    total = 0
+    for content in chat.get_history(curated=True):
+        key = fingerprint(content)
+        total += token_cache[key] if key in token_cache else len(turn_text(content)) // 2
+    return total
+
+# 履歴をやり取り単位（ユーザー発言 + 続くモデル応答）にまとめる
+def group_exchanges(history):
+    exchanges = []
+    for content in history:
+        if content.role == "user" or not exchanges:
+            exchanges.append([content])
+        else:
+            exchanges[-1].append(content)
+    return exchanges
+
+def get_pins(guild_id, channel_id):
+    return pinned_per_ch.setdefault(guild_id, {}).setdefault(channel_id, set())
+
+# 最後のやり取りを固定（削除・要約の対象外にする）
+def pin_last(guild_id, channel_id, chat):
+    exchanges = group_exchanges(chat.get_history(curated=True))
+    if not exchanges:
+        return False
+    get_pins(guild_id, channel_id).add(fingerprint(exchanges[-1][0]))
+    return True
+
+def unpin_all(guild_id, channel_id):
+    pinned_per_ch.get(guild_id, {}).pop(channel_id, None)
+
+# 削除するやり取りを要約したやり取りを作成（応答と同じくスケジューラで呼び出し数を制限する）
+async def summarize(guild_id, channel_id, api_key, model, exchanges):
+    transcript = "\n".join(f"{c.role}: {turn_text(c)}" for exchange in exchanges for c in exchange)
+
+    async def call():
+        return await gemini_client.get_client(api_key).aio.models.generate_content(
+            model=model, contents=SUMMARY_PROMPT + transcript
+        )
+
+    scheduler = rate_limiter.get_scheduler(api_key)
+    est_tokens = len(SUMMARY_PROMPT + transcript) // 2 + 1
+    response = await scheduler.run(guild_id, channel_id, call, est_tokens)
+    if response.usage_metadata:
+        scheduler.record_usage(est_tokens, response.usage_metadata.total_token_count)
+    return [
+        Content(role="user", parts=[Part(text=f"{SUMMARY_PREFIX}\n{response.text}")]),
+        Content(role="model", parts=[Part(text="了解しました。要約を踏まえて会話を続けます。")]),
+    ]
+
+# トークン予算を超えていれば古いやり取りを削除・要約したチャットを返す
+# usage: 直前の応答の usage_metadata。入力と出力のトークン数（システム指示を含むので履歴より多い）が
+#        予算内なら、ターンごとに数えずにそのまま返す
+async def enforce_budget(guild_id, channel_id, chat, inst, api_key, model, usage=None):
+    if usage is not None and usage.prompt_token_count is not None:
+        if usage.prompt_token_count + (usage.candidates_token_count or 0) <= TOKEN_BUDGET:
+            return chat
+    exchanges = group_exchanges(chat.get_history(curated=True))
+    counts = iter(await count_turns_tokens(api_key, model, [content for exchange in exchanges for content in exchange]))
+    sizes = [sum(next(counts) for _ in exchange) for exchange in exchanges]
+    total = sum(sizes)
+    if total <= TOKEN_BUDGET:
+        return chat
+
+    # 古い順に、固定されていないやり取りを削除
+    pins = get_pins(guild_id, channel_id)
+    target = int(TOKEN_BUDGET * TRIM_TARGET)
+    kept, removed = [], []
+    for exchange, size in zip(exchanges, sizes):
+        if total > target and fingerprint(exchange[0]) not in pins and exchange is not exchanges[-1]:
+            removed.append(exchange)
+            total -= size
+        else:
+            kept.append(exchange)
+
+    prefix = []
+    if SUMMARIZE and removed:
+        try:
+            prefix = await summarize(guild_id, channel_id, api_key, model, removed)
+        except Exception as e:
+            print(f"[context_window] 要約エラー: {e}")
+    print(f"[context_window] {guild_id}/{channel_id}: {len(removed)} 件のやり取りを履歴から外しました")
+
+    history = prefix + [content for exchange in kept for content in exchange]
+    return gemini_client.create_chat(api_key, model, inst, history)
@@ -1,492 +1,971 @@
-import discord
-import os
-import io
-import re
-import sys
-import json
-import asyncio
-import datetime
-import concurrent.futures
-from dotenv import load_dotenv
-from google import genai
-from google.genai import types
-from google.genai.types import Content, Part
-
-
-# モジュール読み込みパス追加
-sys.path.append('/app/shared')
-import config
-
-# グローバル変数
-bot_client = None
-GEMINI_TOKEN = None
-model_name = "gemini-2.0-flash"  # 使用するAIモデル名
-message_buffer_per_ch = {}  # チャンネルごとのメッセージバッファ
-is_responding_per_ch = {}  # チャンネルごとのAI応答状態
-message_locks_per_ch = {}  # チャンネルごとのロック
-executor = concurrent.futures.ThreadPoolExecutor()  # 非同期実行のためのスレッドプール
-lastmessage_metadata = None
-
-# 非同期ロックを取得するためのヘルパー関数
-def get_lock(guild_id, channel_id):
-    return message_locks_per_ch.setdefault(guild_id, {}).setdefault(channel_id, asyncio.Lock())
-
-# 同期関数を非同期に実行するためのヘルパー関数
-def run_blocking(func, *args):
-    loop = asyncio.get_running_loop()
-    return loop.run_in_executor(executor, func, *args)
-
-# 設定された応答チャンネルをリスト表示
-async def list_channel(message):
-    guild_id = str(message.guild.id)
-
-    if guild_id not in config.allowed_channels_per_guild or not config.allowed_channels_per_guild[guild_id]:
-        await message.channel.send("!このサーバーには応答チャンネルが設定されていません。")
-        return
-
-    # チャンネル一覧の作成
-    channel_mentions = []
-    for ch_id in config.allowed_channels_per_guild[guild_id]:
-        ch = message.guild.get_channel(ch_id)
-        if ch:
-            channel_mentions.append(f"<#{ch_id}>")
-        else:
-            channel_mentions.append(f"`{ch_id}`（見つかりません）")
-
-    # チャンネル情報の送信
-    channels_text = "\n".join(channel_mentions)
-    await message.channel.send(f"!現在設定されている応答チャンネル一覧:\n{channels_text}")
-
-# 設定ファイルを送信する関数
-async def send_config(message, config_path):
-    if not os.path.exists(config_path):
-        await message.channel.send("!設定ファイルが存在しません。")
-        return
-    try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        filename = f"{message.guild.id}_{message.channel.id}_config.txt"
-        file = discord.File(io.BytesIO(content.encode()), filename)
-        await message.channel.send("!設定ファイルを送信します。", file=file)
-    except Exception as e:
-        print(f"[send_config] エラー: {e}")
-        await message.channel.send("!設定ファイルの送信に失敗しました。")
-
-# 設定ファイルをリセットする関数
-async def reset_config(message, config_path):
-    await send_config(message, config_path)
-    try:
-        os.remove(config_path)
-        await message.channel.send("!設定ファイルを削除しました。")
-    except Exception as e:
-        print(f"[reset_config] エラー: {e}")
-        await message.channel.send("!設定ファイルの削除に失敗しました。")
-
-# チャット履歴をJSON形式に変換する関数
-def convert_chat_history_to_json(chat):
-    def content_to_dict(content):
-        parts_text_only = []
-        for part in content.parts:
-            if hasattr(part, "text"):
-                parts_text_only.append(part.text)
-            else:
-                parts_text_only.append(str(part))  # 保険的に他の型も文字列化
-        return {"role": content.role, "parts": parts_text_only}
-    return [content_to_dict(c) for c in chat.get_history(curated=True)]
-
-
-# チャット履歴をメッセージとして送信
-async def send_history(message, chat):
-    history_json = convert_chat_history_to_json(chat)
-    filename = f"chat_history_{message.guild.id}_{message.channel.id}.json"
-
-    try:
-        # JSON形式の履歴ファイルを送信
-        file = discord.File(io.BytesIO(json.dumps(history_json, ensure_ascii=False, separators=(',', ':')).encode()), filename)
-        await message.channel.send("!チャット履歴ファイルを送信します。", file=file)
-    except Exception as e:
-        print(f"[send_chat_history] エラー: {e}")
-        await message.channel.send("!チャット履歴の送信に失敗しました。")
-
-# チャット履歴を指定したディレクトリに保存
-def save_chat(chat, config_path, guild_id, save_dir, name="!chatdata"):
-    # ギルドディレクトリの作成
-    guild_dir = os.path.join(save_dir, f"{guild_id}")
-    os.makedirs(guild_dir, exist_ok=True)
-    
-    # 名前とタイムスタンプの作成
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    base_name = f"{name}_{timestamp}"
-    save_path = os.path.join(guild_dir, f"{base_name}")
-    os.makedirs(save_path, exist_ok=True)
-    
-    # JSONファイルの保存
-    history_json = convert_chat_history_to_json(chat)
-    with open(os.path.join(save_path, f"history_{base_name}.json"), "w", encoding="utf-8") as f:
-        json.dump(history_json, f, ensure_ascii=False, separators=(',', ':'))
-    
-    # 設定ファイルの保存
-    if os.path.exists(config_path):
-        with open(config_path, "r", encoding="utf-8") as src, \
-             open(os.path.join(save_path, f"config_{base_name}.txt"), "w", encoding="utf-8") as dst:
-            dst.write(src.read())
-    
-    # READMEファイルの保存
-    with open(os.path.join(save_path, f"readme_{base_name}.txt"), "w", encoding="utf-8") as f:
-        f.write("試験的に保存されたチャット履歴です。")
-    
-    print(f"チャット履歴が保存されました: {base_name}")
-    return base_name
-
-# チャット履歴一覧を表示
-async def list_chat(message):
-    guild_id = str(message.guild.id)
-    guild_dir = f"/app/shared/saved_chat/{guild_id}"
-    
-    # ギルドディレクトリが存在しない場合
-    if not os.path.exists(guild_dir):
-        await message.channel.send("!保存されたチャット履歴はありません。")
-        return
-
-    # ギルドディレクトリ内の保存されたチャットを検索
-    saved_chats = []
-    for subdir in os.listdir(guild_dir):
-        subdir_path = os.path.join(guild_dir, subdir)
-        if os.path.isdir(subdir_path):
-            # readmeファイルの読み込み
-            readme_path = os.path.join(subdir_path, f"readme_{subdir}.txt")
-            if os.path.exists(readme_path):
-                with open(readme_path, "r", encoding="utf-8") as f:
-                    description = f.read().strip()
-            else:
-                description = "説明がありません。"
-
-            # 保存されたチャットの情報をリストに追加
-            saved_chats.append({
-                "name": subdir,
-                "description": description
-            })
-    
-    # チャット履歴が存在する場合
-    if saved_chats:
-        chat_list_text = "\n".join([f"**{chat['name']}**: {chat['description']}" for chat in saved_chats])
-        await message.channel.send(f"!保存されたチャット履歴一覧:\n{chat_list_text}")
-    else:
-        await message.channel.send("!保存されたチャット履歴はありません。")
-
-def load_chat(guild_id, chat_dir, channel_id, ch_config_path):
-    # チャット履歴ファイルのパス
-    load_history_path = f"/app/shared/saved_chat/{guild_id}/{chat_dir}/history_{chat_dir}.json"
-    # 設定ファイルのパス
-    load_config_path = f"/app/shared/saved_chat/{guild_id}/{chat_dir}/config_{chat_dir}.txt"
-
-    # 履歴ファイルが存在しない場合はエラー
-    if not os.path.exists(load_history_path):
-        return None
-
-    # チャット履歴の読み込み
-    with open(load_history_path, "r", encoding="utf-8") as f:
-        history_dicts = json.load(f)
-    
-    history = [
-        Content(
-            role=item["role"],
-            parts=[
-                Part(text=p) if isinstance(p, str) else Part(**p)
-                for p in item["parts"]
-            ]
-        )
-        for item in history_dicts
-    ]
-
-    # 設定ファイルの読み込み
-    inst = ""
-    if os.path.exists(load_config_path):
-        with open(load_config_path, "r", encoding="utf-8") as f:
-            inst = f.read()
-
-    # 設定ファイルを`chat_config` で上書き
-    os.makedirs(os.path.dirname(ch_config_path), exist_ok=True)
-    with open(ch_config_path, "w", encoding="utf-8") as f:
-        f.write(inst)
-
-    # チャットオブジェクトを作成して返す
-    client = genai.Client(api_key=GEMINI_TOKEN)
-    chat = client.chats.create(
-        model=model_name,
-        history=history,
-        config=types.GenerateContentConfig(system_instruction=inst)
-    )
-
-    return chat
-
-# 最後に記憶しているメッセージを送信する関数
-async def send_last_message(message, chat):
-    history = chat.get_history(curated=True)
-    if not history:
-        await message.channel.send("!履歴が空です。")
-        return
-
-    last = history[-1]
-    role = last.role
-    parts = [part.text for part in last.parts if hasattr(part, "text")]
-    text = "\n".join(parts) if parts else "(内容なし)"
-
-    await message.channel.send(f"!最後のメッセージ:\n**{role}**: {text}")
-
-# チャット履歴を復元する関数
-def restore_chat(filepath, config_path):
-    # チャット履歴の復元
-    with open(filepath, "r", encoding="utf-8") as f:
-        history_dicts = json.load(f)
-    history = [Content(role=item["role"], parts=[Part(**p) for p in item["parts"]]) for item in history_dicts]
-
-    # 設定ファイルの復元
-    inst = ""
-    if os.path.exists(config_path):
-        try:
-            with open(config_path, 'r', encoding='utf-8') as f:
-                inst = f.read()
-        except Exception as e:
-            print(f"[restore_chat] 設定ファイルの読み込みエラー: {e}")
-            inst = ""
-
-    # チャットオブジェクトの復元
-    client = genai.Client(api_key=GEMINI_TOKEN)
-    return client.chats.create(
-        model=model_name,
-        history=history,
-        config=types.GenerateContentConfig(system_instruction=inst)
-    )
-
-
-
-# 初期化関数
-def ready(client, token):
-    global bot_client, GEMINI_TOKEN
-    bot_client, GEMINI_TOKEN = client, token
-
-
-
-# =====メッセージ処理を行うメイン関数=====
-
-async def handle_message(message, allowed_channels_per_guild, chats_per_ch):
-    global lastmessage_metadata
-    if message.author == bot_client.user or not message.guild:
-        return
-
-    guild_id, channel_id = str(message.guild.id), message.channel.id
-    config_path = f"/app/bot/chat_config/chat_config_{guild_id}/chat_config_{channel_id}.txt"
-    chat = chats_per_ch.get(guild_id, {}).get(channel_id)
-
-    # 許可されたチャンネルでない場合は処理をスキップ
-    if channel_id not in allowed_channels_per_guild.get(guild_id, set()):
-        return
-
-    # メッセージ内容の整形
-    content = message.content.replace("\n", "\\n").replace("\r", "\\r")
-    mention_1 = f"<@{bot_client.user.id}>"
-    mention_2 = f"<@!{bot_client.user.id}>"
-
-    if content.startswith(mention_1):
-        content = content[len(mention_1):].strip()
-    elif content.startswith(mention_2):
-        content = content[len(mention_2):].strip()
-
-    # "!"で始まるコマンドはAIに送信せず処理
-    if content.startswith("!"):
-        if bot_client.user in message.mentions:
-            if content == "!check":
-                await message.channel.send("!このチャンネルを見ています")
-                return
-
-            if content == "!list_channel":
-                await list_channel(message)
-                return
-            if content == "!send_config":
-                await send_config(message, config_path)
-                return
-
-            if content == "!reset_config":
-                await reset_config(message, config_path)
-                return
-
-            if content == "!send_history":
-                # チャット履歴がない場合はエラーメッセージ
-                if chat is None:
-                    await message.channel.send("!チャット履歴が見つかりません。")
-                    return
-
-                await send_history(message, chat)
-                return
-
-            if content == "!reset_chat":
-                # チャット履歴をリセットする処理
-                if guild_id in chats_per_ch and channel_id in chats_per_ch[guild_id]:
-                    chat_history = chats_per_ch[guild_id][channel_id]
-
-                    # チャット履歴を送信
-                    await send_history(message, chat_history)
-
-                    # チャット履歴をリセット
-                    await reset_config(message, config_path)
-                    del chats_per_ch[guild_id][channel_id]
-                    message_buffer_per_ch[guild_id][channel_id] = []
-
-                    await message.channel.send("!チャット履歴がリセットされました。")
-                else:
-                    await message.channel.send("!リセットするチャット履歴が見つかりません。")
-                return
-
-            if content == "!save_chat":
-                # チャット履歴を保存する処理
-                if guild_id in chats_per_ch and channel_id in chats_per_ch[guild_id]:
-                    chat_history = chats_per_ch[guild_id][channel_id]
-
-                    # チャット履歴をリセット
-                    saved_name = save_chat(chat_history, config_path, guild_id, "/app/shared/saved_chat")
-                    await message.channel.send("!チャット履歴が保存されました。")
-                    await message.channel.send(f"{saved_name}")
-                else:
-                    await message.channel.send("!保存するチャット履歴が見つかりません。")
-                return
-
-            if content == "!list_chat":
-                # 保存ディレクトリを指定して履歴一覧を表示
-                await list_chat(message)
-                return
-
-            if content.startswith("!load_chat "):
-                parts = content.split(" ", 1)
-                if len(parts) == 2:
-                    chat_dir = parts[1].strip()
-
-                    # 現在のチャット履歴が存在する場合は事前に送信
-                    if guild_id in chats_per_ch and channel_id in chats_per_ch[guild_id]:
-                        current_chat = chats_per_ch[guild_id][channel_id]
-                        await send_history(message, current_chat)
-                        await send_config(message, config_path)
-                    # チャット履歴と設定をロード
-                    ch_config_path = f"/app/bot/chat_config/chat_config_{guild_id}/chat_config_{channel_id}.txt"
-
-                    chat = load_chat(guild_id, chat_dir, channel_id, ch_config_path)
-                    if chat is None:
-                        await message.channel.send("!指定した履歴ファイルが見つかりません。")
-                        return
-                    # チャットオブジェクトを保存
-                    chats_per_ch.setdefault(guild_id, {})[channel_id] = chat
-                    await message.channel.send(f"!チャット履歴と設定を{chat_dir}から復元しました。")
-                else:
-                    await message.channel.send("!使い方: `!load_chat saved_chat_<名前>_<日時>`")
-                return
-
-
-            if content == "!send_buffered":
-                buffered = message_buffer_per_ch[guild_id][channel_id]
-                if not buffered:
-                    await message.channel.send("!バッファ内容はありません。")
-                    return
-                try:
-                    await message.channel.send(f"!バッファ内容:\n{buffered}")
-                except Exception as e:
-                    print(f"[flush_message_buffer] 送信エラー: {e}")
-
-            if content == "!reset_buffered":
-                message_buffer_per_ch[guild_id][channel_id] = []
-                await message.channel.send("!バッファ内容を削除しました。")
-                return
-
-            if content == "!send_last":
-                if not chat:
-                    await message.channel.send("!チャット履歴がありません。")
-                    return
-                await send_last_message(message, chat)
-                return
-                
-            if content == "!send_lastdata":
-                if not lastmessage_metadata:
-                    await message.channel.send("!送信履歴はありません。")
-                    return
-                try:
-                    await message.channel.send(f"!最後に送信されたチャットのメタデータ:\n{lastmessage_metadata}")
-                except Exception as e:
-                    print(f"[flush_message_buffer] 送信エラー: {e}")
-            
-            else:
-                await message.channel.send("!登録されていない!コマンドです。")
-        return
-
-    # 自分以外へのコマンド命令を無視
-    mention_pattern = r"^<@!?(?P<id>\d+)>"
-
-    match_mention = re.match(mention_pattern, content)
-    if match_mention:
-        mentioned_id = match_mention.group("id")
-        remaining = content[match_mention.end():].strip()
-        if remaining.startswith("!"):
-            return
-        content = remaining
-
-    # メッセージ整形と指示抽出
-    matches = re.findall(r'【(.*?)】', content, re.DOTALL)
-    if matches:
-        if bot_client.user in message.mentions:
-            os.makedirs(os.path.dirname(config_path), exist_ok=True)
-            try:
-                with open(config_path, 'a', encoding='utf-8') as f:
-                    f.writelines(match + '\n' for match in matches)
-            except Exception as e:
-                print(f"[config write] エラー: {e}")
-        for match in matches:
-            content = content.replace(f"【{match}】", "")
-
-    authorname = message.author.display_name
-    modified = f"{authorname}: {content}" if content.strip() else ""
-
-    # 返信状態とメッセージ格納の初期設定
-    is_responding_per_ch.setdefault(guild_id, {}).setdefault(channel_id, False)
-    message_buffer_per_ch.setdefault(guild_id, {}).setdefault(channel_id, [])
-    if bot_client.user not in message.mentions or is_responding_per_ch[guild_id][channel_id]:
-        lock = get_lock(guild_id, channel_id)
-        async with lock:
-            message_buffer_per_ch[guild_id][channel_id].append(f"{modified},\n")
-        return
-
-    # AIによる応答処理
-    is_responding_per_ch[guild_id][channel_id] = True
-    lock = get_lock(guild_id, channel_id)
-    async with lock:
-        if message.author.bot:
-            await asyncio.sleep(5)
-
-        os.makedirs(os.path.dirname(config_path), exist_ok=True)
-        if not os.path.exists(config_path):
-            open(config_path, 'w').close()
-
-        with open(config_path, 'r', encoding='utf-8') as f:
-            inst = f.read()
-
-        chats_per_ch.setdefault(guild_id, {})
-        if channel_id not in chats_per_ch[guild_id]:
-            client = genai.Client(api_key=GEMINI_TOKEN)
-            chats_per_ch[guild_id][channel_id] = client.chats.create(
-                model=model_name,
-                config=types.GenerateContentConfig(system_instruction=inst)
-            )
-
-        chat = chats_per_ch[guild_id][channel_id]
-        buffered = message_buffer_per_ch[guild_id][channel_id]
-        input_text = ",\r\n".join(buffered + [modified])
-
-    async with message.channel.typing():
-        try:
-            response = await run_blocking(chat.send_message, input_text, types.GenerateContentConfig(system_instruction=inst))
-            lastmessage_metadata = message.channel.send(response.usage_metadata)
-            await message.channel.send(response.text)
-            async with lock:
-                message_buffer_per_ch[guild_id][channel_id] = []
-        except Exception as e:
-            print(f"応答エラー: {e}")
-            await message.channel.send("!エラーが発生しました。時間を置いて再試行してください。")
-        finally:
-            is_responding_per_ch[guild_id][channel_id] = False
+import discord
+import os
+import io
+import re
+import sys
+import json
+import asyncio
+import time
+import datetime
+from dotenv import load_dotenv
+from google.genai.types import Content, Part
+
+
+# モジュール読み込みパス追加
+sys.path.append('/app/shared')
+import config
+import gemini_client
+import context_cache
+import reply_sender
+import attachments
+import channel_workers
+import session_evictor
+import instruction_store
+import storage
+import chat_catalog
+import chat_archive
+import chat_search
+import context_window
+import session_log
+import message_buffer
+import rate_limiter
+import metrics
+import shared_state
+
+# グローバル変数
+bot_client = None
+GEMINI_TOKEN = None
+model_name = "gemini-2.0-flash"  # 使用するAIモデル名
+SAVED_CHAT_DIR = "/app/shared/saved_chat"  # 保存チャットの置き場所（ギルドごとのディレクトリ）
+message_buffer_per_ch = {}  # チャンネルごとのメッセージバッファ
+lastmessage_metadata = None
+pending_attachments_per_ch = {}  # チャンネルごとの、まだAIに送っていない添付ファイル（Part）
+session_bytes_per_ch = {}  # (guild_id, channel_id) -> (数えたターン数, 会話のおおよそのバイト数)
+FOLLOWUP_DEBOUNCE = 2.0  # 応答中に届いたメンションは、最後のメンションからこの時間待ってまとめて返答する（秒）
+FOLLOWUP_MAX_DELAY = 10.0  # 応答後にまとめるために待つ最大時間（秒）
+MAX_PENDING_ATTACHMENTS = 10  # 溜めておく添付ファイルの上限（古い順に捨てる）
+ATTACHMENT_TOKENS = 300  # 添付ファイル1件あたりの見積もりトークン数
+STREAM_REPLY = True  # ストリーミング応答（逐次編集）を使うか
+STREAM_EDIT_INTERVAL = 1.2  # メッセージ編集の最小間隔（秒）。Discordのレート制限対策
+STREAM_PLACEHOLDER = "…"  # 応答開始時に送信する仮メッセージ
+DISCORD_MESSAGE_LIMIT = 2000  # Discordの1メッセージあたりの文字数上限
+# /reload_modules で引き継ぐ実行中の状態（応答中の処理も同じ辞書を参照し続ける）
+RUNTIME_STATE = (
+    "bot_client", "GEMINI_TOKEN", "message_buffer_per_ch", "lastmessage_metadata",
+    "pending_attachments_per_ch", "session_bytes_per_ch",
+)
+
+# チャンネルのメッセージバッファを取得するヘルパー関数
+def get_buffer(guild_id, channel_id):
+    buffers = message_buffer_per_ch.setdefault(guild_id, {})
+    if channel_id not in buffers:
+        buffers[channel_id] = message_buffer.MessageBuffer()
+    return buffers[channel_id]
+
+def get_pending_attachments(guild_id, channel_id):
+    return pending_attachments_per_ch.setdefault(guild_id, {}).setdefault(channel_id, [])
+
+# バッファから溢れたメッセージを要約する関数（応答と同じくスケジューラで呼び出し数を制限する）
+async def summarize_buffer(guild_id, channel_id, text):
+    contents = f"以下のチャットの流れを、後で会話に参加するために必要な要点だけ日本語で簡潔に要約してください。\n\n{text}"
+
+    async def call():
+        return await gemini_client.get_client(GEMINI_TOKEN).aio.models.generate_content(
+            model=model_name, contents=contents
+        )
+
+    scheduler = rate_limiter.get_scheduler(GEMINI_TOKEN)
+    est_tokens = message_buffer.estimate_tokens(contents)
+    response = await scheduler.run(guild_id, channel_id, call, est_tokens)
+    if response.usage_metadata:
+        scheduler.record_usage(est_tokens, response.usage_metadata.total_token_count)
+    return response.text
+
+# ストリーミング応答を仮メッセージの編集で逐次表示する関数
+async def stream_reply(placeholder, chat, request, gen_config):
+    loop = asyncio.get_running_loop()
+
+    text = ""
+    usage = None
+    shown = ""
+    last_edit = loop.time()
+    start = time.perf_counter()
+    async for chunk in await chat.send_message_stream(request, gen_config):
+        if not text:
+            metrics.observe("gemini_first_chunk", time.perf_counter() - start)
+        text += chunk.text or ""
+        if chunk.usage_metadata:
+            usage = chunk.usage_metadata
+        # 一定間隔ごとにまとめて編集
+        if loop.time() - last_edit >= STREAM_EDIT_INTERVAL and text.strip():
+            preview = text[:DISCORD_MESSAGE_LIMIT]
+            if preview != shown:
+                try:
+                    with metrics.timer("discord_send"):
+                        await placeholder.edit(content=preview)
+                    shown = preview
+                except Exception as e:
+                    print(f"[stream_reply] 編集エラー: {e}")
+            last_edit = loop.time()
+    metrics.observe("gemini", time.perf_counter() - start)
+
+    # 最終結果で確定（上限を超える場合は分割して続きを送信）
+    final = text if text.strip() else "(内容なし)"
+    if len(final) > DISCORD_MESSAGE_LIMIT:
+        await reply_sender.send_long(placeholder.channel, final, placeholder)
+    elif final != shown:
+        with metrics.timer("discord_send"):
+            await placeholder.edit(content=final)
+    return text, usage
+
+def _is_plain_text(part):
+    return getattr(part, "text", None) is not None and not getattr(part, "thought", None)
+
+# ストリーミング応答は受け取った断片ごとに別のモデルのターンとして履歴に入るため、
+# 最後の応答を1ターンにまとめた履歴を返す（まとめる必要がなければNone）
+def merge_streamed_reply(history):
+    start = len(history)
+    while start > 0 and history[start - 1].role == "model":
+        start -= 1
+    if len(history) - start < 2:
+        return None
+    parts = []
+    for content in history[start:]:
+        for part in content.parts or []:
+            if parts and _is_plain_text(part) and _is_plain_text(parts[-1]):
+                parts[-1] = Part(text=parts[-1].text + part.text)
+            else:
+                parts.append(part)
+    return history[:start] + [Content(role="model", parts=parts)]
+
+# 設定された応答チャンネルをリスト表示
+async def list_channel(message):
+    guild_id = str(message.guild.id)
+
+    if guild_id not in config.allowed_channels_per_guild or not config.allowed_channels_per_guild[guild_id]:
+        await message.channel.send("!このサーバーには応答チャンネルが設定されていません。")
+        return
+
+    # チャンネル一覧の作成
+    channel_mentions = []
+    for ch_id in config.allowed_channels_per_guild[guild_id]:
+        ch = message.guild.get_channel(ch_id)
+        if ch:
+            channel_mentions.append(f"<#{ch_id}>")
+        else:
+            channel_mentions.append(f"`{ch_id}`（見つかりません）")
+
+    # チャンネル情報の送信
+    channels_text = "\n".join(channel_mentions)
+    await reply_sender.send_long(message.channel, f"!現在設定されている応答チャンネル一覧:\n{channels_text}", prefix="!")
+
+# 設定ファイルを送信する関数
+async def send_config(message, config_path):
+    if not await storage.exists(config_path):
+        await message.channel.send("!設定ファイルが存在しません。")
+        return
+    try:
+        content = await storage.read_text(config_path)
+        filename = f"{message.guild.id}_{message.channel.id}_config.txt"
+        file = discord.File(io.BytesIO(content.encode()), filename)
+        await message.channel.send("!設定ファイルを送信します。", file=file)
+    except Exception as e:
+        print(f"[send_config] エラー: {e}")
+        await message.channel.send("!設定ファイルの送信に失敗しました。")
+
+# 設定ファイルをリセットする関数
+async def reset_config(message, config_path):
+    await send_config(message, config_path)
+    try:
+        if not await instruction_store.remove(config_path):
+            raise FileNotFoundError(config_path)
+        await context_cache.invalidate(config_path)
+        await message.channel.send("!設定ファイルを削除しました。")
+    except Exception as e:
+        print(f"[reset_config] エラー: {e}")
+        await message.channel.send("!設定ファイルの削除に失敗しました。")
+
+# 1ターンをJSON形式に変換
+def content_to_json(content):
+    parts_text_only = []
+    for part in content.parts:
+        if getattr(part, "text", None) is not None:
+            parts_text_only.append(part.text)
+        else:
+            parts_text_only.append(attachments.describe_part(part))  # 添付ファイルなどは表記のみ残す
+    return {"role": content.role, "parts": parts_text_only}
+
+# チャット履歴をJSON形式に変換する関数
+def convert_chat_history_to_json(chat):
+    return [content_to_json(c) for c in chat.get_history(curated=True)]
+
+
+# チャット履歴をメッセージとして送信
+async def send_history(message, chat):
+    history_json = convert_chat_history_to_json(chat)
+    filename = f"chat_history_{message.guild.id}_{message.channel.id}.json"
+
+    try:
+        # JSON形式の履歴ファイルを送信
+        file = discord.File(io.BytesIO(json.dumps(history_json, ensure_ascii=False, separators=(',', ':')).encode()), filename)
+        await message.channel.send("!チャット履歴ファイルを送信します。", file=file)
+    except Exception as e:
+        print(f"[send_chat_history] エラー: {e}")
+        await message.channel.send("!チャット履歴の送信に失敗しました。")
+
+SAVE_DESCRIPTION = "試験的に保存されたチャット履歴です。"
+
+# 他のbotと名前が衝突しないように保存ディレクトリを確保
+def _reserve_save_dir(guild_dir, base_name):
+    os.makedirs(guild_dir, exist_ok=True)
+    name, suffix = base_name, 1
+    while True:
+        try:
+            os.makedirs(os.path.join(guild_dir, name))
+            return name
+        except FileExistsError:
+            suffix += 1
+            name = f"{base_name}_{suffix}"
+
+# 保存ファイル群を書き出して目録に登録する（I/Oスレッドで実行）
+# JSON形式への変換は1ターンずつ行い、履歴全体の変換結果を持ち続けない
+def _write_saved_chat(guild_dir, base_name, timestamp, contents, config_path):
+    base_name = _reserve_save_dir(guild_dir, base_name)
+
+    # 履歴と設定を圧縮・重複排除して保存（v2形式）
+    config_text = storage.read_text_sync(config_path) if os.path.exists(config_path) else None
+    size = chat_archive.write_save_sync(
+        guild_dir, base_name, timestamp, map(content_to_json, contents), config_text, SAVE_DESCRIPTION
+    )
+
+    # 目録の更新
+    chat_catalog.add_entry_sync(guild_dir, base_name, timestamp, size, len(contents), SAVE_DESCRIPTION)
+
+    # 検索索引の更新（失敗しても保存は成功させ、次の検索時に登録し直す）
+    try:
+        chat_search.index_save_sync(guild_dir, base_name, timestamp, map(content_to_json, contents))
+    except Exception as e:
+        print(f"[chat_search] 索引の更新エラー: {base_name}: {e}")
+    return base_name
+
+# チャット履歴を指定したディレクトリに保存
+async def save_chat(chat, config_path, guild_id, save_dir, name="!chatdata"):
+    # 名前とタイムスタンプの作成
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    guild_dir = os.path.join(save_dir, f"{guild_id}")
+
+    contents = list(chat.get_history(curated=True))  # 保存中に応答が追加されても影響しないように複製
+    base_name = await storage.run_io(_write_saved_chat, guild_dir, f"{name}_{timestamp}", timestamp, contents, config_path)
+
+    print(f"チャット履歴が保存されました: {base_name}")
+    return base_name
+
+# チャット履歴一覧を表示（!list_chat [ページ] [並び順] [キーワード]）
+async def list_chat(message, args=""):
+    guild_id = str(message.guild.id)
+    guild_dir = os.path.join(SAVED_CHAT_DIR, guild_id)
+
+    # 引数の解釈
+    page, sort, keywords = 1, "new", []
+    for arg in args.split():
+        if arg.isdigit():
+            page = int(arg)
+        elif arg in chat_catalog.SORT_ORDERS:
+            sort = arg
+        else:
+            keywords.append(arg)
+    keyword = " ".join(keywords) or None
+
+    # 目録から該当ページを取得
+    saved_chats, total = await chat_catalog.list_entries(guild_dir, sort, keyword, page)
+
+    # チャット履歴が存在する場合
+    if saved_chats:
+        pages = (total + chat_catalog.PAGE_SIZE - 1) // chat_catalog.PAGE_SIZE
+        lines = []
+        for chat in saved_chats:
+            description = chat["description"][:chat_catalog.DESCRIPTION_PREVIEW]
+            lines.append(f"**{chat['name']}** ({chat['turns']}件, {chat['size'] // 1024}KB): {description}")
+        chat_list_text = "\n".join(lines)
+        await reply_sender.send_long(
+            message.channel, f"!保存されたチャット履歴一覧 ({page}/{pages}ページ, 全{total}件):\n{chat_list_text}", prefix="!"
+        )
+    elif total:
+        await message.channel.send(f"!{page}ページ目はありません。")
+    else:
+        await message.channel.send("!保存されたチャット履歴はありません。")
+
+# JSON形式の1ターンをContentに変換
+def content_from_json(item):
+    return Content(
+        role=item["role"],
+        parts=[Part(text=p) if isinstance(p, str) else Part(**p) for p in item["parts"]]
+    )
+
+# JSON形式の履歴をContentのリストに変換
+def history_from_json(history_dicts):
+    return [content_from_json(item) for item in history_dicts]
+
+# 保存済みの履歴と設定を読み込む（I/Oスレッドで実行）。v1・v2のどちらの形式も読む
+def _read_saved_chat(guild_dir, chat_dir):
+    # 履歴が存在しない場合はエラー
+    if not chat_archive.exists_sync(guild_dir, chat_dir):
+        return None
+
+    # チャット履歴の読み込み（1ターンずつ展開しながら変換）
+    history = [content_from_json(item) for item in chat_archive.iter_history_sync(guild_dir, chat_dir)]
+
+    # 設定の読み込み
+    inst = chat_archive.read_config_sync(guild_dir, chat_dir)
+    return history, inst
+
+async def load_chat(guild_id, chat_dir, channel_id, ch_config_path):
+    guild_dir = os.path.join(SAVED_CHAT_DIR, guild_id)
+    if not chat_archive.is_save_name(chat_dir):
+        return None
+    # 目録で存在を確認（未登録の場合はディレクトリを確認して登録）
+    if await chat_catalog.get_entry(guild_dir, chat_dir) is None:
+        if not await storage.exists(os.path.join(guild_dir, chat_dir)):
+            return None
+        await chat_catalog.index_save(guild_dir, chat_dir)
+
+    loaded = await storage.run_io(_read_saved_chat, guild_dir, chat_dir)
+    if loaded is None:
+        return None
+    history, inst = loaded
+
+    # 設定ファイルを`chat_config` で上書き
+    await instruction_store.write(ch_config_path, inst)
+    await context_cache.invalidate(ch_config_path)
+
+    # チャットオブジェクトを作成して返す
+    return gemini_client.create_chat(GEMINI_TOKEN, model_name, inst, history)
+
+# 最後に記憶しているメッセージを送信する関数
+async def send_last_message(message, chat):
+    history = chat.get_history(curated=True)
+    if not history:
+        await message.channel.send("!履歴が空です。")
+        return
+
+    last = history[-1]
+    role = last.role
+    parts = [part.text for part in last.parts if hasattr(part, "text")]
+    text = "\n".join(parts) if parts else "(内容なし)"
+
+    await reply_sender.send_long(message.channel, f"!最後のメッセージ:\n**{role}**: {text}", prefix="!")
+
+# チャット履歴を復元する関数
+async def restore_chat(filepath, config_path):
+    # チャット履歴の復元
+    history = history_from_json(await storage.read_json(filepath))
+
+    # 設定ファイルの復元
+    inst = ""
+    if await storage.exists(config_path):
+        try:
+            inst = await storage.read_text(config_path)
+        except Exception as e:
+            print(f"[restore_chat] 設定ファイルの読み込みエラー: {e}")
+            inst = ""
+
+    # チャットオブジェクトの復元
+    return gemini_client.create_chat(GEMINI_TOKEN, model_name, inst, history)
+
+
+
+# 再起動後（またはメモリから追い出した後）に初めて触れたチャンネルの会話をログから復元する関数
+async def restore_session(guild_id, channel_id, config_path, chats_per_ch):
+    spilled = await session_evictor.restore_buffer(guild_id, channel_id)
+    if spilled is not None:
+        _restore_buffer(guild_id, channel_id, spilled)
+    history_json = await session_log.load(guild_id, channel_id)
+    if history_json is None:
+        return None
+    inst = await instruction_store.get(config_path)
+    chat = gemini_client.create_chat(GEMINI_TOKEN, model_name, inst, history_from_json(history_json))
+    chats_per_ch.setdefault(guild_id, {})[channel_id] = chat
+    forget_session_size(guild_id, channel_id)
+    print(f"[session_log] 会話を復元しました: {guild_id}/{channel_id} ({len(history_json)}ターン)")
+    return chat
+
+# 退避したバッファと添付ファイルを戻す（戻すまでの間に届いたメッセージは後ろに付ける）
+def _restore_buffer(guild_id, channel_id, spilled):
+    buffers = message_buffer_per_ch.setdefault(guild_id, {})
+    restored = message_buffer.MessageBuffer.from_dict(spilled["buffer"] or {})
+    existing = buffers.get(channel_id)
+    if existing is not None:
+        for entry in existing.entries:
+            restored.append(entry["author"], entry["text"], entry["time"])
+    buffers[channel_id] = restored
+    parts = [Part.model_validate(p) for p in spilled.get("attachments", [])]
+    pending = get_pending_attachments(guild_id, channel_id)
+    pending[:0] = parts
+    del pending[:-MAX_PENDING_ATTACHMENTS]
+
+def _history_bytes(contents):
+    return sum(len(context_window.turn_text(content).encode()) for content in contents)
+
+# 履歴を追記以外で置き換えたときに呼ぶ（次の確認で数え直す）
+def forget_session_size(guild_id, channel_id):
+    session_bytes_per_ch.pop((guild_id, channel_id), None)
+
+# メモリ上の会話のおおよそのサイズ（バイト）
+# 履歴は追記されていくだけなので、前回数えた後に増えたターンだけを数える
+def _session_sizes(chats_per_ch):
+    sizes = {}
+    for guild_id, chats in chats_per_ch.items():
+        for channel_id, chat in chats.items():
+            key = (guild_id, channel_id)
+            history = chat.get_history(curated=True)
+            turns, size = session_bytes_per_ch.get(key, (0, 0))
+            if turns > len(history):
+                turns, size = 0, 0
+            if turns < len(history):
+                size += _history_bytes(history[turns:])
+                session_bytes_per_ch[key] = (len(history), size)
+            sizes[key] = size
+    for guild_id, buffers in message_buffer_per_ch.items():
+        for channel_id, buffer in buffers.items():
+            key = (guild_id, channel_id)
+            sizes[key] = sizes.get(key, 0) + buffer.total_bytes
+    return sizes
+
+def _is_busy(key):
+    worker = channel_workers.get_worker(*key)
+    return worker is not None and (worker.busy or not worker.queue.empty())
+
+# 使われていないチャンネルの会話をディスクへ退避してメモリから外す
+async def evict_idle_sessions(chats_per_ch):
+    sizes = _session_sizes(chats_per_ch)
+    victims = session_evictor.select_victims(sizes, _is_busy)
+    evicted = 0
+    for guild_id, channel_id in victims:
+        key = (guild_id, channel_id)
+        used = session_evictor.last_used.get(key)
+        chat = chats_per_ch.get(guild_id, {}).get(channel_id)
+        buffer = message_buffer_per_ch.get(guild_id, {}).get(channel_id)
+        pending = pending_attachments_per_ch.get(guild_id, {}).get(channel_id)
+        try:
+            if chat is not None:
+                await session_log.write_snapshot(guild_id, channel_id, convert_chat_history_to_json(chat))
+            if buffer or pending:
+                await session_evictor.spill_buffer(guild_id, channel_id, {
+                    "buffer": buffer.to_dict() if buffer else None,
+                    "attachments": [p.model_dump(mode="json", exclude_none=True) for p in pending or []],
+                })
+            # 退避中に使われた場合は取りやめる
+            if session_evictor.last_used.get(key) != used or _is_busy(key):
+                await storage.remove(session_evictor.buffer_path(guild_id, channel_id))
+                continue
+        except Exception as e:
+            print(f"[session_evictor] 退避エラー {guild_id}/{channel_id}: {e}")
+            continue
+        # ここから先は await しない（途中で届いたメッセージが半端な状態を見ないように）
+        chats_per_ch.get(guild_id, {}).pop(channel_id, None)
+        message_buffer_per_ch.get(guild_id, {}).pop(channel_id, None)
+        pending_attachments_per_ch.get(guild_id, {}).pop(channel_id, None)
+        forget_session_size(guild_id, channel_id)
+        session_log.forget(guild_id, channel_id)
+        instruction_store.invalidate(config.chat_config_path(guild_id, channel_id))
+        session_evictor.mark_evicted(guild_id, channel_id)
+        evicted += 1
+    session_evictor.resident_sessions = len(sizes) - evicted
+    if evicted:
+        print(f"[session_evictor] {evicted} チャンネルの会話をメモリから退避しました")
+
+async def run_session_evictor(chats_per_ch):
+    while True:
+        await asyncio.sleep(session_evictor.SWEEP_INTERVAL)
+        try:
+            await evict_idle_sessions(chats_per_ch)
+        except Exception as e:
+            print(f"[session_evictor] エラー: {e}")
+
+# メトリクスのゲージ（取得時に集計）
+def _collect_buffer_messages():
+    return [({"guild": g}, sum(len(b) for b in channels.values())) for g, channels in message_buffer_per_ch.items()]
+
+def _collect_buffer_bytes():
+    return [({"guild": g}, sum(b.total_bytes for b in channels.values())) for g, channels in message_buffer_per_ch.items()]
+
+def _collect_responding():
+    counts = {}
+    for worker in channel_workers.workers.values():
+        counts[worker.key[0]] = counts.get(worker.key[0], 0) + (1 if worker.responding else 0)
+    return [({"guild": g}, n) for g, n in counts.items()]
+
+def _collect_sessions():
+    return [({"state": "resident"}, session_evictor.resident_sessions), ({"state": "spilled"}, len(session_evictor.spilled))]
+
+def _collect_evictions():
+    return [({"kind": kind}, count) for kind, count in session_evictor.stats.items()]
+
+def _collect_workers():
+    return [({}, len(channel_workers.workers))]
+
+def _collect_worker_queue():
+    return [({}, channel_workers.queued_events())]
+
+def _collect_queue_depth():
+    return [({}, sum(s.depth() for s in rate_limiter.schedulers.values()))]
+
+metrics.register_gauge("discord_bot_buffer_messages", "Buffered (unsent) messages per guild", _collect_buffer_messages)
+metrics.register_gauge("discord_bot_buffer_bytes", "Buffered (unsent) bytes per guild", _collect_buffer_bytes)
+metrics.register_gauge("discord_bot_responding_channels", "Channels currently waiting for Gemini per guild", _collect_responding)
+metrics.register_gauge("discord_bot_gemini_queue_depth", "Mentions waiting in the Gemini scheduler", _collect_queue_depth)
+metrics.register_gauge("discord_bot_sessions", "Channel sessions held in memory or spilled to disk", _collect_sessions)
+metrics.register_gauge("discord_bot_session_evictions", "Sessions spilled to disk / restored since start", _collect_evictions)
+metrics.register_gauge("discord_bot_channel_workers", "Active per-channel workers", _collect_workers)
+metrics.register_gauge("discord_bot_channel_queue_depth", "Messages waiting in per-channel worker queues", _collect_worker_queue)
+
+# 初期化関数
+def ready(client, token):
+    global bot_client, GEMINI_TOKEN
+    bot_client, GEMINI_TOKEN = client, token
+    # 会話ログはbotごとに分ける（同じチャンネルにいる他のbotと混ざらないように）
+    session_log.set_namespace(client.user.id)
+
+
+
+# =====!コマンドの処理=====
+
+# コマンド処理に渡す情報
+class CommandContext:
+    def __init__(self, message, guild_id, channel_id, config_path, chat, chats_per_ch, args):
+        self.message = message
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.config_path = config_path
+        self.chat = chat
+        self.chats_per_ch = chats_per_ch
+        self.args = args
+
+async def cmd_check(ctx):
+    await ctx.message.channel.send("!このチャンネルを見ています")
+
+async def cmd_list_channel(ctx):
+    await list_channel(ctx.message)
+
+async def cmd_send_config(ctx):
+    await send_config(ctx.message, ctx.config_path)
+
+async def cmd_reset_config(ctx):
+    await reset_config(ctx.message, ctx.config_path)
+
+async def cmd_send_history(ctx):
+    # チャット履歴がない場合はエラーメッセージ
+    if ctx.chat is None:
+        await ctx.message.channel.send("!チャット履歴が見つかりません。")
+        return
+    await send_history(ctx.message, ctx.chat)
+
+async def cmd_reset_chat(ctx):
+    message, guild_id, channel_id = ctx.message, ctx.guild_id, ctx.channel_id
+    # チャット履歴をリセットする処理
+    if ctx.chat is None:
+        await message.channel.send("!リセットするチャット履歴が見つかりません。")
+        return
+
+    # チャット履歴を送信
+    await send_history(message, ctx.chat)
+
+    # チャット履歴をリセット
+    await reset_config(message, ctx.config_path)
+    del ctx.chats_per_ch[guild_id][channel_id]
+    forget_session_size(guild_id, channel_id)
+    await session_log.clear(guild_id, channel_id)
+    get_buffer(guild_id, channel_id).clear()
+
+    await message.channel.send("!チャット履歴がリセットされました。")
+
+async def cmd_save_chat(ctx):
+    # チャット履歴を保存する処理
+    if ctx.chat is None:
+        await ctx.message.channel.send("!保存するチャット履歴が見つかりません。")
+        return
+    saved_name = await save_chat(ctx.chat, ctx.config_path, ctx.guild_id, SAVED_CHAT_DIR)
+    await ctx.message.channel.send("!チャット履歴が保存されました。")
+    await ctx.message.channel.send(f"{saved_name}")
+
+async def cmd_list_chat(ctx):
+    # 目録から履歴一覧を表示
+    await list_chat(ctx.message, ctx.args)
+
+async def cmd_search_chat(ctx):
+    query = ctx.args.strip()
+    if not query:
+        await ctx.message.channel.send("!使い方: `!search_chat <検索語>`（空白区切りで全ての語を含むものを検索）")
+        return
+    guild_dir = os.path.join(SAVED_CHAT_DIR, ctx.guild_id)
+    await reply_sender.send_long(ctx.message.channel, await chat_search.search(guild_dir, query), prefix="!")
+
+async def cmd_load_chat(ctx):
+    message, guild_id, channel_id = ctx.message, ctx.guild_id, ctx.channel_id
+    chat_dir = ctx.args.strip()
+    if not chat_dir:
+        await message.channel.send("!使い方: `!load_chat saved_chat_<名前>_<日時>`")
+        return
+
+    # 現在のチャット履歴が存在する場合は事前に送信
+    if ctx.chat is not None:
+        await send_history(message, ctx.chat)
+        await send_config(message, ctx.config_path)
+
+    # チャット履歴と設定をロード
+    chat = await load_chat(guild_id, chat_dir, channel_id, ctx.config_path)
+    if chat is None:
+        await message.channel.send("!指定した履歴ファイルが見つかりません。")
+        return
+    # チャットオブジェクトを保存
+    ctx.chats_per_ch.setdefault(guild_id, {})[channel_id] = chat
+    forget_session_size(guild_id, channel_id)
+    await session_log.write_snapshot(guild_id, channel_id, convert_chat_history_to_json(chat))
+    await message.channel.send(f"!チャット履歴と設定を{chat_dir}から復元しました。")
+
+async def cmd_send_buffered(ctx):
+    buffer = get_buffer(ctx.guild_id, ctx.channel_id)
+    if not buffer:
+        await ctx.message.channel.send("!バッファ内容はありません。")
+        return
+    stats = buffer.stats()
+    try:
+        await reply_sender.send_long(
+            ctx.message.channel,
+            "!バッファ状況:\n"
+            f"メッセージ数: {stats['messages']}（結合 {stats['merged']}件, 破棄 {stats['dropped']}件）\n"
+            f"サイズ: {stats['bytes']}バイト / 約{stats['tokens']}トークン\n"
+            f"最古のメッセージ: {stats['oldest_age']}秒前\n"
+            f"要約: {'あり' if stats['has_summary'] else 'なし'}（要約待ち {stats['pending_summary']}件）",
+            prefix="!"
+        )
+    except Exception as e:
+        print(f"[flush_message_buffer] 送信エラー: {e}")
+
+async def cmd_reset_buffered(ctx):
+    get_buffer(ctx.guild_id, ctx.channel_id).clear()
+    await ctx.message.channel.send("!バッファ内容を削除しました。")
+
+async def cmd_send_last(ctx):
+    if not ctx.chat:
+        await ctx.message.channel.send("!チャット履歴がありません。")
+        return
+    await send_last_message(ctx.message, ctx.chat)
+
+async def cmd_pin_last(ctx):
+    if not ctx.chat or not context_window.pin_last(ctx.guild_id, ctx.channel_id, ctx.chat):
+        await ctx.message.channel.send("!固定するやり取りがありません。")
+        return
+    await ctx.message.channel.send("!最後のやり取りを固定しました。履歴の削減・要約の対象外になります。")
+
+async def cmd_unpin_all(ctx):
+    context_window.unpin_all(ctx.guild_id, ctx.channel_id)
+    await ctx.message.channel.send("!固定を全て解除しました。")
+
+async def cmd_send_lastdata(ctx):
+    if not lastmessage_metadata:
+        await ctx.message.channel.send("!送信履歴はありません。")
+        return
+    try:
+        await reply_sender.send_long(ctx.message.channel, f"!最後に送信されたチャットのメタデータ:\n{lastmessage_metadata}", prefix="!")
+    except Exception as e:
+        print(f"[flush_message_buffer] 送信エラー: {e}")
+
+# !コマンドの一覧（コマンド名 -> (処理関数, 引数を取るか)）
+COMMANDS = {
+    "!check": (cmd_check, False),
+    "!list_channel": (cmd_list_channel, False),
+    "!send_config": (cmd_send_config, False),
+    "!reset_config": (cmd_reset_config, False),
+    "!send_history": (cmd_send_history, False),
+    "!reset_chat": (cmd_reset_chat, False),
+    "!save_chat": (cmd_save_chat, False),
+    "!list_chat": (cmd_list_chat, True),
+    "!load_chat": (cmd_load_chat, True),
+    "!search_chat": (cmd_search_chat, True),
+    "!send_buffered": (cmd_send_buffered, False),
+    "!reset_buffered": (cmd_reset_buffered, False),
+    "!send_last": (cmd_send_last, False),
+    "!pin_last": (cmd_pin_last, False),
+    "!unpin_all": (cmd_unpin_all, False),
+    "!send_lastdata": (cmd_send_lastdata, False),
+}
+
+# チャンネルのワーカーで応答と順番に実行するコマンド
+WORKER_COMMANDS = {cmd_reset_chat, cmd_load_chat, cmd_reset_buffered}
+
+# 事前コンパイルした正規表現
+MENTION_PATTERN = re.compile(r"^<@!?(?P<id>\d+)>")
+INSTRUCTION_PATTERN = re.compile(r'【(.*?)】', re.DOTALL)
+
+
+
+# =====メッセージ処理を行うメイン関数=====
+
+async def handle_message(message, chats_per_ch):
+    # 許可されたチャンネルでない場合は即座にスキップ（大半のメッセージはここで終わる）
+    guild = message.guild
+    if guild is None or (guild.id, message.channel.id) not in config.allowed_channel_index:
+        return
+    if message.author == bot_client.user:
+        return
+
+    guild_id, channel_id = str(guild.id), message.channel.id
+    config_path = config.chat_config_path(guild_id, channel_id)
+    session_evictor.touch(guild_id, channel_id)
+    chat = chats_per_ch.get(guild_id, {}).get(channel_id)
+
+    # メッセージ内容の整形
+    content = message.content.replace("\n", "\\n").replace("\r", "\\r")
+    mention_1 = f"<@{bot_client.user.id}>"
+    mention_2 = f"<@!{bot_client.user.id}>"
+
+    if content.startswith(mention_1):
+        content = content[len(mention_1):].strip()
+    elif content.startswith(mention_2):
+        content = content[len(mention_2):].strip()
+
+    # "!"で始まるコマンドはAIに送信せず処理
+    if content.startswith("!"):
+        if bot_client.user in message.mentions:
+            name, _, args = content.partition(" ")
+            command = COMMANDS.get(name)
+            if command is None or (args.strip() and not command[1]):
+                await message.channel.send("!登録されていない!コマンドです。")
+                return
+            handler, _ = command
+            ctx = CommandContext(message, guild_id, channel_id, config_path, chat, chats_per_ch, args)
+            if handler not in WORKER_COMMANDS and chat is not None:
+                await handler(ctx)
+                return
+            # 会話の状態を変えるコマンドは応答と順番に処理する（応答中の書き戻しで取り消されないように）
+            # 会話がまだメモリに無い場合も、ワーカーでログから復元してから実行する
+            event = {
+                "command": handler, "ctx": ctx, "mentioned": False,
+                "config_path": config_path, "chats_per_ch": chats_per_ch, "queued_at": time.perf_counter(),
+            }
+            if not channel_workers.submit(guild_id, channel_id, event, process_events):
+                await message.channel.send("!混み合っているため、このコマンドは受け付けられませんでした。少し待ってから送り直してください。")
+        return
+
+    # 自分以外へのコマンド命令を無視
+    match_mention = MENTION_PATTERN.match(content)
+    if match_mention:
+        mentioned_id = match_mention.group("id")
+        remaining = content[match_mention.end():].strip()
+        if remaining.startswith("!"):
+            return
+        content = remaining
+
+    # メッセージ整形と指示抽出
+    matches = INSTRUCTION_PATTERN.findall(content)
+    if matches:
+        if bot_client.user in message.mentions:
+            try:
+                await instruction_store.append(config_path, matches)
+            except Exception as e:
+                print(f"[config write] エラー: {e}")
+        for match in matches:
+            content = content.replace(f"【{match}】", "")
+
+    # 添付ファイルの読み込み（本文には名前だけ残す）
+    new_parts = []
+    if message.attachments:
+        new_parts, skipped = await attachments.ingest(GEMINI_TOKEN, guild_id, message.attachments)
+        if new_parts:
+            names = ", ".join(a.filename for a in message.attachments if a.filename not in {s[0] for s in skipped})
+            content = f"{content} [添付ファイル: {names}]".strip()
+        if skipped:
+            lines = "\n".join(f"- {name}（{reason}）" for name, reason in skipped)
+            await message.channel.send(f"!読み込めなかった添付ファイルがあります:\n{lines}")
+
+    # チャンネルのワーカーに渡す（処理はチャンネルごとに順番に行う）
+    event = {
+        "author": message.author.display_name, "content": content, "parts": new_parts,
+        "mentioned": bot_client.user in message.mentions, "channel": message.channel,
+        "config_path": config_path, "chats_per_ch": chats_per_ch, "queued_at": time.perf_counter(),
+    }
+    if not channel_workers.submit(guild_id, channel_id, event, process_events):
+        # キューが一杯なら受け付けない（メンションにだけ知らせる）
+        print(f"[channel_workers] キューが一杯です: {guild_id}/{channel_id}")
+        if event["mentioned"]:
+            await message.channel.send("!混み合っているため、このメッセージは受け付けられませんでした。少し待ってから送り直してください。")
+
+# =====応答処理=====
+
+# イベントをバッファに積む
+def apply_event(guild_id, channel_id, event):
+    metrics.observe("channel_queue_wait", time.perf_counter() - event["queued_at"])
+    get_buffer(guild_id, channel_id).append(event["author"], event["content"])
+    if event["parts"]:
+        pending = get_pending_attachments(guild_id, channel_id)
+        pending.extend(event["parts"])
+        del pending[:-MAX_PENDING_ATTACHMENTS]
+
+# ワーカーで実行するコマンド。会話は実行時点のものを使う
+async def run_command(guild_id, channel_id, event):
+    metrics.observe("channel_queue_wait", time.perf_counter() - event["queued_at"])
+    ctx = event["ctx"]
+    ctx.chat = ctx.chats_per_ch.get(guild_id, {}).get(channel_id)
+    try:
+        await event["command"](ctx)
+    except Exception as e:
+        print(f"[command] エラー {guild_id}/{channel_id}: {e}")
+
+async def respond_to(worker, mentions):
+    guild_id, channel_id = worker.key
+    last = mentions[-1]
+    worker.responding = True
+    try:
+        await respond(last["channel"], guild_id, channel_id, last["config_path"], last["chats_per_ch"])
+    finally:
+        worker.responding = False
+        worker.responded_at = time.perf_counter()
+
+# ワーカーから呼ばれる。届いたメッセージを積み、メンションがあれば1回にまとめて返答する
+# コマンドは届いた順に実行する（それより前のメンションには先に返答する）
+async def process_events(worker, events):
+    guild_id, channel_id = worker.key
+    # 再起動後（またはメモリから追い出した後）の初回は、会話を使う前にログから復元する
+    # ワーカーの中で行うので、復元中に届いたメッセージが空の会話で返答されることはない
+    chats_per_ch = events[0]["chats_per_ch"]
+    if chats_per_ch.get(guild_id, {}).get(channel_id) is None:
+        await restore_session(guild_id, channel_id, events[0]["config_path"], chats_per_ch)
+    mentions = []
+    for event in events:
+        if "command" in event:
+            if mentions:
+                await respond_to(worker, mentions)
+                mentions = []
+            await run_command(guild_id, channel_id, event)
+            continue
+        apply_event(guild_id, channel_id, event)
+        if event["mentioned"]:
+            mentions.append(event)
+    if not mentions:
+        return
+
+    # 前の応答中に届いたメンションは、少し待って続けて届くものとまとめる（コマンドが届いたら待つのをやめる）
+    deferred = None
+    if mentions[0]["queued_at"] < worker.responded_at:
+        loop = asyncio.get_running_loop()
+        limit = loop.time() + FOLLOWUP_MAX_DELAY
+        deadline = min(loop.time() + FOLLOWUP_DEBOUNCE, limit)
+        while (event := await worker.next_event(deadline - loop.time())) is not None:
+            if "command" in event:
+                deferred = event
+                break
+            apply_event(guild_id, channel_id, event)
+            if event["mentioned"]:
+                mentions.append(event)
+                deadline = min(loop.time() + FOLLOWUP_DEBOUNCE, limit)
+
+    await respond_to(worker, mentions)
+    if deferred is not None:
+        await run_command(guild_id, channel_id, deferred)
+
+# バッファの内容をAIに送り、返答する
+async def respond(channel, guild_id, channel_id, config_path, chats_per_ch):
+    global lastmessage_metadata
+    buffer = get_buffer(guild_id, channel_id)
+    with metrics.timer("config_load"):
+        inst = await instruction_store.get(config_path)
+
+    chats_per_ch.setdefault(guild_id, {})
+    if channel_id not in chats_per_ch[guild_id]:
+        chats_per_ch[guild_id][channel_id] = gemini_client.create_chat(GEMINI_TOKEN, model_name, inst)
+
+    chat = chats_per_ch[guild_id][channel_id]
+    # アップロードしたファイルは期限（48時間）が切れると送信が失敗するため、期限切れのものは名前の表記に置き換える
+    if (history := attachments.strip_expired_uploads(chat.get_history(curated=True))) is not None:
+        chat = chats_per_ch[guild_id][channel_id] = gemini_client.create_chat(GEMINI_TOKEN, model_name, inst, history)
+        forget_session_size(guild_id, channel_id)
+    if buffer.needs_summary():
+        await buffer.compact(lambda text: summarize_buffer(guild_id, channel_id, text))
+    sent_seq = buffer.seal()
+    input_text = buffer.render(sent_seq)
+    pending = get_pending_attachments(guild_id, channel_id)
+    pending[:] = [part for part in pending if not attachments.is_expired(part)]
+    parts = list(pending)
+    if not input_text and not parts:
+        return
+    request = [input_text, *parts] if parts else input_text
+
+    async with channel.typing():
+        placeholder = None
+        try:
+            async def send_to_gemini(gen_config):
+                if STREAM_REPLY:
+                    return await stream_reply(placeholder, chat, request, gen_config)
+                with metrics.timer("gemini"):
+                    response = await chat.send_message(request, gen_config)
+                await reply_sender.send_long(placeholder.channel, response.text or "(内容なし)", placeholder)
+                return response.text, response.usage_metadata
+
+            # Gemini呼び出し（レート制限・再試行はスケジューラが担当）
+            # 長いシステム指示はキャッシュを使い、キャッシュ起因の失敗は通常送信でやり直す
+            async def call_gemini():
+                gen_config = await context_cache.generate_config(GEMINI_TOKEN, model_name, config_path, inst)
+                try:
+                    return await send_to_gemini(gen_config)
+                except Exception as e:
+                    if gen_config.cached_content is None or not context_cache.is_cache_error(e):
+                        raise
+                    print(f"[context_cache] キャッシュを使わずに再送します: {e}")
+                    await context_cache.discard(GEMINI_TOKEN, model_name, inst)
+                    return await send_to_gemini(context_cache.plain_config(inst))
+
+            # 順番待ちの場合は仮メッセージに待ち順を表示
+            async def show_queued(position):
+                await placeholder.edit(content=f"!混み合っています。順番待ち中です（{position}番目）")
+
+            scheduler = rate_limiter.get_scheduler(GEMINI_TOKEN)
+            est_tokens = (message_buffer.estimate_tokens(input_text) + ATTACHMENT_TOKENS * len(parts)
+                          + context_window.estimate_history_tokens(chat))
+            # 他のbotと同じチャンネルで応答が重ならないようにリースを取る
+            # 同時呼び出し数はbot全体で制限する。枠はスケジューラで順番が来たときに取るので、
+            # 枠が埋まっている間もギルド・チャンネルごとに公平に並び、仮メッセージに待ち順が表示される
+            async with shared_state.channel_lease(guild_id, channel_id):
+                with metrics.timer("discord_send"):
+                    placeholder = await channel.send(STREAM_PLACEHOLDER)
+                _, lastmessage_metadata = await scheduler.run(
+                    guild_id, channel_id, call_gemini, est_tokens, show_queued, channel_workers.get_inflight_semaphore()
+                )
+            if lastmessage_metadata:
+                scheduler.record_usage(est_tokens, lastmessage_metadata.total_token_count)
+                metrics.add_usage(guild_id, channel_id, lastmessage_metadata)
+            if STREAM_REPLY and (history := merge_streamed_reply(chat.get_history(curated=True))) is not None:
+                chat = gemini_client.create_chat(GEMINI_TOKEN, model_name, inst, history)
+            buffer.discard_through(sent_seq)
+            sent_ids = {id(part) for part in parts}
+            pending[:] = [part for part in pending if id(part) not in sent_ids]
+
+            # 履歴がトークン予算を超えていれば削減
+            try:
+                trimmed = await context_window.enforce_budget(
+                    guild_id, channel_id, chat, inst, GEMINI_TOKEN, model_name, lastmessage_metadata
+                )
+            except Exception as e:
+                print(f"[context_window] 履歴削減エラー: {e}")
+                trimmed = chat
+
+            chats_per_ch[guild_id][channel_id] = trimmed
+            if trimmed is not chat:
+                forget_session_size(guild_id, channel_id)
+
+            # 会話ログへ書き込み（削減した場合はスナップショット）
+            try:
+                history_json = convert_chat_history_to_json(trimmed)
+                if trimmed is chat:
+                    await session_log.record_exchange(guild_id, channel_id, history_json)
+                else:
+                    await session_log.write_snapshot(guild_id, channel_id, history_json)
+            except Exception as e:
+                print(f"[session_log] 書き込みエラー: {e}")
+        except Exception as e:
+            print(f"応答エラー: {e}")
+            error_text = "!エラーが発生しました。時間を置いて再試行してください。"
+            if placeholder is not None:
+                await placeholder.edit(content=error_text)
+            else:
+                await channel.send(error_text)
\ No newline at end of file
@@ -0,0 +1,26 @@
+from google import genai
+from google.genai import types
+
+# APIキーごとに共有するクライアント（HTTP接続プールを使い回す）
+clients_per_key = {}
+RUNTIME_STATE = ("clients_per_key",)  # 再読み込みで引き継ぐ
+HTTP_TIMEOUT_MS = 120 * 1000  # Gemini API呼び出しのタイムアウト（ミリ秒）
+
+# APIキーに対応する長寿命クライアントを取得
+def get_client(api_key):
+    client = clients_per_key.get(api_key)
+    if client is None:
+        client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(timeout=HTTP_TIMEOUT_MS)
+        )
+        clients_per_key[api_key] = client
+    return client
+
+# 非同期(aio)チャットを作成
+def create_chat(api_key, model, inst="", history=None):
+    return get_client(api_key).aio.chats.create(
+        model=model,
+        history=history,
+        config=types.GenerateContentConfig(system_instruction=inst)
+    )
@@ -0,0 +1,36 @@
+import sys
+import time
+import importlib
+
+# 実行中の状態を引き継ぎながらモジュールを再読み込みする
+# 各モジュールは RUNTIME_STATE（引き継ぐ変数名のタプル）と after_reload(old_vars)（任意）で挙動を指定する
+# 再読み込みは await を挟まずに行うため、途中で on_message が割り込むことはない
+RELOAD_WARN_SECONDS = 1.0  # これを超えたら警告を出す（秒）
+
+def reload_module(module):
+    old_vars = dict(vars(module))
+    module = importlib.reload(module)
+    # 新しい版の RUNTIME_STATE に従って、旧版のオブジェクトをそのまま差し戻す
+    for name in getattr(module, "RUNTIME_STATE", ()):
+        if name in old_vars:
+            setattr(module, name, old_vars[name])
+    after_reload = getattr(module, "after_reload", None)
+    if after_reload is not None:
+        after_reload(old_vars)
+    return module
+
+# 依存される側から順に再読み込み（未読み込みのモジュールは飛ばす）
+def reload_modules(names):
+    start = time.perf_counter()
+    reloaded = []
+    for name in names:
+        module = sys.modules.get(name)
+        if module is None:
+            continue
+        reload_module(module)
+        reloaded.append(name)
+    elapsed = time.perf_counter() - start
+    print(f"[hot_reload] {len(reloaded)} 個のモジュールを再読み込みしました（{elapsed * 1000:.1f}ms）")
+    if elapsed > RELOAD_WARN_SECONDS:
+        print(f"[hot_reload] 再読み込みに時間がかかっています: {elapsed:.1f}秒")
+    return reloaded
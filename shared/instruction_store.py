@@ -0,0 +1,97 @@
+import os
+import asyncio
+import storage
+
+# チャンネルごとのシステム指示をメモリに保持するキャッシュ
+# path -> {"text": 内容, "mtime": ファイル更新時刻, "version": 書き込み世代, "checked": 最終確認時刻}
+instructions = {}
+path_locks = {}  # ファイルごとの書き込みロック
+RUNTIME_STATE = ("instructions", "path_locks")  # 再読み込みで引き継ぐ
+MTIME_CHECK_INTERVAL = 5.0  # 外部変更（他プロセス・手動編集）を確認する間隔（秒）
+
+def get_path_lock(path):
+    return path_locks.setdefault(path, asyncio.Lock())
+
+# ファイルの更新時刻を取得（存在しなければNone）
+def _stat_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _read(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        return text, os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return "", None
+
+def _write(path, text, mode):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode, encoding="utf-8") as f:
+        f.write(text)
+    return os.stat(path).st_mtime_ns
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+# ロック取得済みの状態でキャッシュを検証・再読込
+async def _refresh(path):
+    loop = asyncio.get_running_loop()
+    entry = instructions.get(path)
+    if entry is not None:
+        mtime = await storage.run_io(_stat_mtime, path)
+        if mtime == entry["mtime"]:
+            entry["checked"] = loop.time()
+            return entry
+    text, mtime = await storage.run_io(_read, path)
+    version = entry["version"] + 1 if entry else 0
+    entry = {"text": text, "mtime": mtime, "version": version, "checked": loop.time()}
+    instructions[path] = entry
+    return entry
+
+# システム指示を取得（キャッシュ優先、一定間隔で更新時刻を確認）
+async def get(path):
+    entry = instructions.get(path)
+    if entry is not None and asyncio.get_running_loop().time() - entry["checked"] < MTIME_CHECK_INTERVAL:
+        return entry["text"]
+    async with get_path_lock(path):
+        return (await _refresh(path))["text"]
+
+# 行を追記（メモリに即時反映し、ファイルへ非同期に書き込む）
+async def append(path, lines):
+    added = "".join(line + "\n" for line in lines)
+    async with get_path_lock(path):
+        entry = await _refresh(path)
+        entry["text"] += added
+        entry["version"] += 1
+        entry["mtime"] = await storage.run_io(_write, path, added, "a")
+
+# 内容を丸ごと置き換え
+async def write(path, text):
+    async with get_path_lock(path):
+        entry = instructions.get(path)
+        version = entry["version"] + 1 if entry else 0
+        mtime = await storage.run_io(_write, path, text, "w")
+        instructions[path] = {"text": text, "mtime": mtime, "version": version,
+                              "checked": asyncio.get_running_loop().time()}
+
+# ファイルを削除してキャッシュも破棄
+async def remove(path):
+    async with get_path_lock(path):
+        instructions.pop(path, None)
+        return await storage.run_io(_remove, path)
+
+# 外部でファイルを書き換えた場合にキャッシュを破棄
+def invalidate(path):
+    instructions.pop(path, None)
+
+# 現在の書き込み世代を取得（未読込ならNone）
+def version(path):
+    entry = instructions.get(path)
+    return entry["version"] if entry else None
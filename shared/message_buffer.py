@@ -0,0 +1,159 @@
+import time
+from collections import deque
+
+# チャンネルごとのメッセージバッファ（AIへ未送信の非メンションメッセージ）
+BUFFER_MAX_BYTES = 32 * 1024  # バッファ全体のバイト上限
+BUFFER_MAX_TOKENS = 8000  # バッファ全体のトークン上限（概算）
+BUFFER_MAX_AGE = 6 * 60 * 60  # これより古いメッセージは溢れ扱い（秒）
+OVERFLOW_POLICY = "drop_oldest"  # "drop_oldest": 古い順に捨てる / "summarize": 要約して残す
+ENTRY_SEPARATOR = ",\r\n"
+
+# トークン数の概算（日本語と英語の中間程度）
+def estimate_tokens(text):
+    return len(text) // 2 + 1
+
+class MessageBuffer:
+    def __init__(self, max_bytes=BUFFER_MAX_BYTES, max_tokens=BUFFER_MAX_TOKENS,
+                 max_age=BUFFER_MAX_AGE, policy=OVERFLOW_POLICY):
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.max_age = max_age
+        self.policy = policy
+        self.entries = deque()  # {"seq", "author", "text", "time", "bytes", "tokens"}
+        self.total_bytes = 0
+        self.total_tokens = 0
+        self.next_seq = 0
+        self.sealed_seq = -1  # 送信中の範囲（これ以前のエントリには結合しない）
+        self.overflow = []  # 要約待ちの溢れたメッセージ
+        self.summary = ""  # 溢れたメッセージの要約
+        self.dropped = 0  # 捨てたメッセージ数
+        self.merged = 0  # 結合したメッセージ数
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __bool__(self):
+        return bool(self.entries or self.summary or self.overflow)
+
+    def _add_size(self, entry, sign):
+        self.total_bytes += sign * entry["bytes"]
+        self.total_tokens += sign * entry["tokens"]
+
+    def _measure(self, entry):
+        line = f"{entry['author']}: {entry['text']}"
+        entry["bytes"] = len(line.encode())
+        entry["tokens"] = estimate_tokens(line)
+
+    # メッセージを追加（同じ発言者が続く場合は結合）
+    def append(self, author, text, now=None):
+        if not text.strip():
+            return
+        now = time.time() if now is None else now
+        last = self.entries[-1] if self.entries else None
+        if last and last["author"] == author and last["seq"] > self.sealed_seq:
+            self._add_size(last, -1)
+            last["text"] += "\\n" + text
+            last["time"] = now
+            self._measure(last)
+            self._add_size(last, 1)
+            self.merged += 1
+        else:
+            entry = {"seq": self.next_seq, "author": author, "text": text, "time": now}
+            self.next_seq += 1
+            self._measure(entry)
+            self._add_size(entry, 1)
+            self.entries.append(entry)
+        self._enforce(now)
+
+    # 上限・期限を超えた古いメッセージを溢れさせる
+    def _enforce(self, now):
+        while self.entries and (
+            self.total_bytes > self.max_bytes
+            or self.total_tokens > self.max_tokens
+            or now - self.entries[0]["time"] > self.max_age
+        ):
+            entry = self.entries.popleft()
+            self._add_size(entry, -1)
+            if self.policy == "summarize":
+                self.overflow.append(entry)
+            else:
+                self.dropped += 1
+
+    def needs_summary(self):
+        return bool(self.overflow)
+
+    # 溢れたメッセージを要約する（summarizerは テキスト -> 要約 の非同期関数）
+    async def compact(self, summarizer):
+        if not self.overflow:
+            return
+        overflow, self.overflow = self.overflow, []
+        text = "\n".join(f"{e['author']}: {e['text']}" for e in overflow)
+        if self.summary:
+            text = f"{self.summary}\n{text}"
+        try:
+            self.summary = await summarizer(text)
+        except Exception as e:
+            print(f"[message_buffer] 要約エラー: {e}")
+            self.dropped += len(overflow)
+
+    # 送信範囲を確定して入力テキストを組み立てる
+    def seal(self):
+        self._enforce(time.time())
+        self.sealed_seq = self.next_seq - 1
+        return self.sealed_seq
+
+    def render(self, through_seq=None):
+        lines = []
+        if self.summary:
+            lines.append(f"（それまでの会話の要約）{self.summary}")
+        for entry in self.entries:
+            if through_seq is not None and entry["seq"] > through_seq:
+                break
+            lines.append(f"{entry['author']}: {entry['text']}")
+        return ENTRY_SEPARATOR.join(lines)
+
+    # 送信済みの範囲を取り除く
+    def discard_through(self, seq):
+        while self.entries and self.entries[0]["seq"] <= seq:
+            self._add_size(self.entries.popleft(), -1)
+        self.summary = ""
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+        self.total_tokens = 0
+        self.overflow = []
+        self.summary = ""
+        self.sealed_seq = self.next_seq - 1
+
+    def stats(self):
+        oldest = time.time() - self.entries[0]["time"] if self.entries else 0
+        return {
+            "messages": len(self.entries),
+            "bytes": self.total_bytes,
+            "tokens": self.total_tokens,
+            "oldest_age": int(oldest),
+            "dropped": self.dropped,
+            "merged": self.merged,
+            "pending_summary": len(self.overflow),
+            "has_summary": bool(self.summary),
+        }
+
+    # ディスクへ退避するための辞書（溢れ待ちのメッセージと要約も含む）
+    def to_dict(self):
+        return {
+            "entries": [{"author": e["author"], "text": e["text"], "time": e["time"]} for e in self.entries],
+            "overflow": self.overflow,
+            "summary": self.summary,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        buffer = cls()
+        for entry in data.get("entries", []):
+            buffer.append(entry["author"], entry["text"], entry["time"])
+            buffer.sealed_seq = buffer.next_seq - 1  # 退避前の区切りを保つ（結合しない）
+        buffer.sealed_seq = -1
+        buffer.overflow = list(data.get("overflow", []))
+        buffer.summary = data.get("summary", "")
+        return buffer
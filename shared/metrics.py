@@ -0,0 +1,121 @@
+import time
+import asyncio
+import contextlib
+
+# 段階ごとの処理時間・トークン使用量・キュー/バッファ深さの計測（Prometheusテキスト形式で公開）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+stage_histograms = {}  # stage -> {"buckets": [...], "sum": 秒, "count": 回数}
+token_counters = {}  # (guild_id, channel_id, kind) -> トークン数
+gauges = {}  # name -> (説明, 値を返す関数 -> [(labels, value)])
+metrics_server = None
+RUNTIME_STATE = ("stage_histograms", "token_counters", "gauges", "metrics_server")  # 再読み込みで引き継ぐ
+
+# 段階の処理時間を記録
+def observe(stage, seconds):
+    hist = stage_histograms.get(stage)
+    if hist is None:
+        hist = stage_histograms[stage] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            hist["buckets"][i] += 1
+    hist["sum"] += seconds
+    hist["count"] += 1
+
+# with metrics.timer("gemini"): のように使う
+@contextlib.contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+# response.usage_metadata からトークン数を加算
+def add_usage(guild_id, channel_id, usage):
+    if usage is None:
+        return
+    for kind, value in (
+        ("prompt", usage.prompt_token_count),
+        ("candidates", usage.candidates_token_count),
+        ("total", usage.total_token_count),
+    ):
+        if value:
+            key = (guild_id, channel_id, kind)
+            token_counters[key] = token_counters.get(key, 0) + value
+
+def guild_tokens(guild_id, kind="total"):
+    return sum(v for (g, _, k), v in token_counters.items() if g == guild_id and k == kind)
+
+# 取得時に値を計算するゲージを登録
+def register_gauge(name, description, collect):
+    gauges[name] = (description, collect)
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+# Prometheusテキスト形式で出力
+def render():
+    lines = [
+        "# HELP discord_bot_stage_seconds Time spent per processing stage",
+        "# TYPE discord_bot_stage_seconds histogram",
+    ]
+    for stage, hist in stage_histograms.items():
+        for bound, count in zip(BUCKETS, hist["buckets"]):
+            lines.append(f'discord_bot_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'discord_bot_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist["count"]}')
+        lines.append(f'discord_bot_stage_seconds_sum{{stage="{stage}"}} {hist["sum"]}')
+        lines.append(f'discord_bot_stage_seconds_count{{stage="{stage}"}} {hist["count"]}')
+
+    lines.append("# HELP discord_bot_gemini_tokens_total Gemini tokens used per guild and channel")
+    lines.append("# TYPE discord_bot_gemini_tokens_total counter")
+    for (guild_id, channel_id, kind), value in token_counters.items():
+        labels = _labels({"guild": guild_id, "channel": channel_id, "kind": kind})
+        lines.append(f"discord_bot_gemini_tokens_total{labels} {value}")
+
+    for name, (description, collect) in gauges.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        try:
+            for labels, value in collect():
+                lines.append(f"{name}{_labels(labels)} {value}")
+        except Exception as e:
+            print(f"[metrics] ゲージ取得エラー: {name}: {e}")
+    return "\n".join(lines) + "\n"
+
+# 段階ごとの平均時間（/stats表示用）
+def stage_summary():
+    return {
+        stage: (hist["count"], hist["sum"] / hist["count"])
+        for stage, hist in stage_histograms.items() if hist["count"]
+    }
+
+async def _handle_http(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request_line.split()[1].decode() if len(request_line.split()) > 1 else "/"
+        if path.startswith("/metrics"):
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        print(f"[metrics] HTTPエラー: {e}")
+    finally:
+        writer.close()
+
+# ローカルのメトリクスエンドポイントを起動（起動済みなら何もしない）
+async def start_server(host="127.0.0.1", port=9100):
+    global metrics_server
+    if metrics_server is not None:
+        return metrics_server
+    metrics_server = await asyncio.start_server(_handle_http, host, port)
+    print(f"メトリクスを公開しました: http://{host}:{port}/metrics")
+    return metrics_server
@@ -0,0 +1,60 @@
+"""保存チャットを v1 形式（history_*.json など）から v2 形式（圧縮・重複排除）に変換するツール
+
+使い方: python /app/shared/migrate_saved_chats.py [--root /app/shared/saved_chat] [--guild ID] [--keep] [--gc] [--dry-run]
+  --keep    変換後も v1 のファイルを残す
+  --gc      どの保存からも参照されていない blob を削除する
+  --dry-run 変換対象を表示するだけで書き込まない
+bot の起動中に実行してもよい（変換済みの保存は飛ばすので、途中で止めても再実行できる）
+"""
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import storage
+import chat_archive
+import chat_catalog
+
+SAVED_CHAT_ROOT = "/app/shared/saved_chat"
+
+def migrate_guild(guild_dir, keep=False, gc=False, dry_run=False):
+    migrated = 0
+    before = sum(file_size for _, _, file_size in storage.walk_files_sync(guild_dir))
+    for name in sorted(storage.list_subdirs_sync(guild_dir)):
+        save_path = os.path.join(guild_dir, name)
+        if not chat_archive.is_save_name(name) or chat_archive.is_v2(save_path):
+            continue
+        if not os.path.exists(os.path.join(save_path, f"history_{name}.json")):
+            continue
+        if dry_run:
+            print(f"  変換対象: {name}")
+            migrated += 1
+            continue
+        try:
+            if chat_archive.migrate_save_sync(guild_dir, name, "説明がありません。", remove_old=not keep):
+                chat_catalog.index_save_sync(guild_dir, name)
+                migrated += 1
+        except Exception as e:
+            print(f"  変換エラー: {name}: {e}")
+    removed = 0 if dry_run or not gc else chat_archive.collect_garbage_sync(guild_dir)
+    after = sum(file_size for _, _, file_size in storage.walk_files_sync(guild_dir))
+    print(f"{guild_dir}: 変換 {migrated} 件 / 削除したblob {removed} 件 / {before} -> {after} bytes")
+    return migrated
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default=SAVED_CHAT_ROOT)
+    parser.add_argument("--guild", help="対象のギルドID（省略時は全て）")
+    parser.add_argument("--keep", action="store_true")
+    parser.add_argument("--gc", action="store_true")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    guilds = [args.guild] if args.guild else sorted(storage.list_subdirs_sync(args.root))
+    total = 0
+    for guild_id in guilds:
+        total += migrate_guild(os.path.join(args.root, guild_id), args.keep, args.gc, args.dry_run)
+    print(f"合計 {total} 件")
+
+if __name__ == "__main__":
+    main()
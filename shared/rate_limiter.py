@@ -0,0 +1,178 @@
+import time
+import random
+import asyncio
+import metrics
+from collections import OrderedDict, deque
+from google.genai import errors
+
+# APIキーごとのGemini呼び出し制限（gemini-2.0-flash 無料枠相当）
+REQUESTS_PER_MINUTE = 15
+TOKENS_PER_MINUTE = 1000000
+MAX_RETRIES = 4  # 再試行の最大回数
+BACKOFF_BASE = 2.0  # 再試行の基本待ち時間（秒）
+BACKOFF_MAX = 60.0  # 再試行の最大待ち時間（秒）
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+schedulers = {}  # APIキー -> GeminiScheduler
+RUNTIME_STATE = ("schedulers",)  # 再読み込みで引き継ぐ（待機中のジョブを失わないように）
+
+# 引き継いだスケジューラも新しい版のメソッドを使う
+def after_reload(old_vars):
+    for scheduler in schedulers.values():
+        scheduler.__class__ = GeminiScheduler
+
+# 再試行してよいエラーか判定
+def is_retryable(error):
+    if isinstance(error, errors.APIError):
+        return error.code in RETRYABLE_CODES
+    return isinstance(error, (asyncio.TimeoutError, ConnectionError))
+
+# ジッター付き指数バックオフ（full jitter）
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # amount を消費できるまでの待ち時間（秒）
+    def wait_time(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    # 消費（負の値で返却。実使用量との差の補正にも使う）
+    def consume(self, amount):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+class GeminiScheduler:
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.queues = OrderedDict()  # guild_id -> OrderedDict(channel_id -> deque(job))
+        self.wakeup = asyncio.Event()
+        self.dispatcher = None
+
+    def depth(self):
+        return sum(len(q) for channels in self.queues.values() for q in channels.values())
+
+    # ギルド → チャンネルの順で公平に（ラウンドロビンで）次のジョブを取り出す
+    @staticmethod
+    def _pop_next(queues):
+        while queues:
+            guild_id, channels = next(iter(queues.items()))
+            channel_id, queue = next(iter(channels.items()))
+            job = queue.popleft()
+            if queue:
+                channels.move_to_end(channel_id)
+            else:
+                del channels[channel_id]
+            if channels:
+                queues.move_to_end(guild_id)
+            else:
+                del queues[guild_id]
+            return job
+        return None
+
+    # 待ち順（1始まり）を計算
+    def position(self, job):
+        queues = OrderedDict(
+            (g, OrderedDict((c, deque(q)) for c, q in channels.items())) for g, channels in self.queues.items()
+        )
+        position = 1
+        while (queued := self._pop_next(queues)) is not None:
+            if queued is job:
+                return position
+            position += 1
+        return position
+
+    def _ensure_dispatcher(self):
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        while True:
+            job = self._pop_next(self.queues)
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            if job["grant"].done():
+                continue  # 待機中にキャンセルされた
+            # 同時呼び出しの枠が空くまで待つ（枠を待つ間も他のジョブはこのキューで公平に並ぶ）
+            slots = job.get("slots")
+            if slots is not None:
+                await slots.acquire()
+                if job["grant"].done():
+                    slots.release()
+                    continue
+            while (delay := max(self.requests.wait_time(1), self.tokens.wait_time(job["tokens"]))) > 0:
+                await asyncio.sleep(delay)
+            self.requests.consume(1)
+            self.tokens.consume(job["tokens"])
+            if job["grant"].done():
+                if slots is not None:
+                    slots.release()
+                continue
+            job["held"] = slots is not None
+            job["grant"].set_result(None)
+
+    # 順番が来るまで待ち、ジョブを返す（slots を渡した場合は、その枠を1つ確保した状態で返る）
+    async def _wait_turn(self, guild_id, channel_id, est_tokens, on_queued, slots=None):
+        job = {"grant": asyncio.get_running_loop().create_future(), "tokens": est_tokens, "slots": slots}
+        busy = (self.depth() > 0 or self.requests.wait_time(1) > 0 or self.tokens.wait_time(est_tokens) > 0
+                or (slots is not None and slots.locked()))
+        self.queues.setdefault(guild_id, OrderedDict()).setdefault(channel_id, deque()).append(job)
+        self._ensure_dispatcher()
+        self.wakeup.set()
+        if busy and on_queued is not None:
+            try:
+                await on_queued(self.position(job))
+            except Exception as e:
+                print(f"[rate_limiter] 待機表示エラー: {e}")
+        try:
+            with metrics.timer("queue_wait"):
+                await job["grant"]
+        except asyncio.CancelledError:
+            if not job["grant"].cancel() and job.get("held"):
+                slots.release()
+            raise
+        return job
+
+    # 制限内で factory() を実行し、再試行可能なエラーはバックオフして再実行
+    # slots（asyncio.Semaphore）を渡すと、順番が来たときにその枠を取り、factory() の実行中だけ占有する
+    async def run(self, guild_id, channel_id, factory, est_tokens=1, on_queued=None, slots=None):
+        for attempt in range(MAX_RETRIES + 1):
+            job = await self._wait_turn(guild_id, channel_id, est_tokens, on_queued, slots)
+            try:
+                return await factory()
+            except Exception as e:
+                if attempt >= MAX_RETRIES or not is_retryable(e):
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"[rate_limiter] 再試行します({attempt + 1}/{MAX_RETRIES}, {delay:.1f}秒後): {e}")
+            finally:
+                if job.get("held"):
+                    job["held"] = False
+                    slots.release()
+            await asyncio.sleep(delay)
+
+    # 見積もりと実際のトークン使用量の差を補正
+    def record_usage(self, est_tokens, actual_tokens):
+        if actual_tokens is not None:
+            self.tokens.consume(actual_tokens - est_tokens)
+
+def get_scheduler(api_key):
+    if api_key not in schedulers:
+        schedulers[api_key] = GeminiScheduler()
+    return schedulers[api_key]
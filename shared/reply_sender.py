@@ -0,0 +1,90 @@
+import io
+import re
+import asyncio
+import discord
+import metrics
+
+# Discordの文字数上限に合わせて長文を分割し、順番に送信する
+MESSAGE_LIMIT = 2000  # Discordの1メッセージあたりの文字数上限
+ATTACHMENT_THRESHOLD = 6000  # これを超える長文はファイルで添付する（文字数）
+ATTACHMENT_NAME = "reply.md"
+SEND_INTERVAL = 1.0  # 分割送信の間隔（秒）。チャンネルごとのレート制限対策
+SENTENCE_ENDS = ("。", "！", "？", "!", "?", ".", "」")
+FENCE_PATTERN = re.compile(r"^\s*```(.*)$")
+send_locks = {}  # channel_id -> 送信ロック（複数の分割送信が混ざらないように）
+
+def get_send_lock(channel_id):
+    return send_locks.setdefault(channel_id, asyncio.Lock())
+
+# text の先頭から limit 文字以内で、なるべく自然な区切り位置を探す
+def _break_point(text, limit):
+    if len(text) <= limit:
+        return len(text)
+    window = text[:limit]
+    for separator in ("\n\n", "\n"):
+        index = window.rfind(separator)
+        if index > limit // 3:
+            return index + len(separator)
+    best = max((window.rfind(end) + len(end) for end in SENTENCE_ENDS), default=0)
+    if best > limit // 3:
+        return best
+    index = window.rfind(" ")
+    if index > limit // 3:
+        return index + 1
+    return limit
+
+# 末尾時点で開いているコードブロックの言語指定（開いていなければNone）
+def _open_fence(text, fence=None):
+    for line in text.split("\n"):
+        match = FENCE_PATTERN.match(line)
+        if match:
+            fence = None if fence is not None else match.group(1).strip()
+    return fence
+
+# 段落・文の区切りで分割する。コードブロックは各チャンク内で閉じ、次のチャンクで開き直す
+def split_message(text, limit=MESSAGE_LIMIT, prefix=""):
+    chunks = []
+    fence = None
+    while text:
+        head = prefix if chunks else ""
+        if fence is not None:
+            head += f"```{fence}\n"
+        budget = limit - len(head) - len("\n```")
+        cut = _break_point(text, budget)
+        body, text = text[:cut], text[cut:]
+        fence = _open_fence(body, fence)
+        chunk = head + body
+        if fence is not None:
+            chunk = chunk.rstrip("\n") + "\n```"
+        if chunk.strip():
+            chunks.append(chunk)
+    return chunks
+
+def _attachment(text):
+    return discord.File(io.BytesIO(text.encode("utf-8")), filename=ATTACHMENT_NAME)
+
+# 長文を送信する。placeholder があれば先頭チャンクはその編集で済ませる
+# prefix は2通目以降の先頭に付ける（!コマンドの出力を他のbotに拾わせないため）
+async def send_long(channel, text, placeholder=None, prefix=""):
+    chunks = split_message(text, prefix=prefix) or ["(内容なし)"]
+    if len(text) > ATTACHMENT_THRESHOLD:
+        # 長すぎる場合は先頭だけ本文に出し、全文はファイルで送る
+        first = chunks[0]
+        async with get_send_lock(channel.id):
+            with metrics.timer("discord_send"):
+                if placeholder is not None:
+                    await placeholder.edit(content=first)
+                    await channel.send(f"{prefix}全文（{len(text)}文字）を添付します。", file=_attachment(text))
+                else:
+                    await channel.send(first, file=_attachment(text))
+        return
+
+    async with get_send_lock(channel.id):
+        for i, chunk in enumerate(chunks):
+            if i > 0:
+                await asyncio.sleep(SEND_INTERVAL)
+            with metrics.timer("discord_send"):
+                if i == 0 and placeholder is not None:
+                    await placeholder.edit(content=chunk)
+                else:
+                    await channel.send(chunk)
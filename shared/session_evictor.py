@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import contextlib
+from collections import OrderedDict
+import storage
+import session_log
+import shared_state
+
+# 使われていないチャンネルの会話（チャット・バッファ）をメモリから追い出す
+# 履歴は会話ログ（session_log）のスナップショットに、未送信のバッファは別ファイルに退避し、次に使われたときに戻す
+SESSION_TTL = 6 * 60 * 60  # 最後に使われてからこの時間が経ったら追い出す（秒）
+MAX_RESIDENT = 1000  # メモリに置いておくチャンネル数の上限
+MEMORY_BUDGET = 256 * 1024 * 1024  # メモリに置いておく会話の合計サイズの上限（概算バイト）
+SWEEP_INTERVAL = 60.0  # 追い出しの確認間隔（秒）
+
+last_used = OrderedDict()  # (guild_id, channel_id) -> 最終使用時刻(monotonic)。古い順
+spilled = set()  # 追い出してまだ戻していないチャンネル
+buffer_checked = set()  # 退避したバッファの確認が済んだチャンネル
+stats = {"evicted": 0, "restored": 0}
+resident_sessions = 0  # 前回の確認時点でメモリにあったチャンネル数
+RUNTIME_STATE = ("last_used", "spilled", "buffer_checked", "stats", "resident_sessions")  # 再読み込みで引き継ぐ
+
+def touch(guild_id, channel_id):
+    key = (guild_id, channel_id)
+    last_used[key] = time.monotonic()
+    last_used.move_to_end(key)
+
+# 追い出すチャンネルを選ぶ。sizes: チャンネル -> 概算バイト（メモリにあるもの全て）
+# 期限切れのもの、および件数・サイズの上限を超えている間は古い順に選ぶ。is_busy(key) が真のものは飛ばす
+def select_victims(sizes, is_busy):
+    now = time.monotonic()
+    for key in sizes:
+        last_used.setdefault(key, now)  # 記録のないもの（再読み込み前から居るものなど）は今から数える
+    resident, total = len(sizes), sum(sizes.values())
+    victims = []
+    for key, used in list(last_used.items()):
+        if key not in sizes:
+            del last_used[key]
+            continue
+        over = resident > MAX_RESIDENT or total > MEMORY_BUDGET
+        if now - used < SESSION_TTL and not over:
+            break
+        if is_busy(key):
+            continue
+        victims.append(key)
+        resident -= 1
+        total -= sizes[key]
+    return victims
+
+def buffer_path(guild_id, channel_id):
+    return os.path.join(session_log.SESSION_DIR, f"{guild_id}", f"{channel_id}.buffer.json")
+
+def _take_spill_sync(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+    return data
+
+# 未送信のバッファ（と添付ファイル）を退避
+async def spill_buffer(guild_id, channel_id, data):
+    await storage.run_io(shared_state.atomic_write_json, buffer_path(guild_id, channel_id), data)
+
+def mark_evicted(guild_id, channel_id):
+    key = (guild_id, channel_id)
+    last_used.pop(key, None)
+    spilled.add(key)
+    buffer_checked.discard(key)
+    stats["evicted"] += 1
+
+# 退避したバッファを取り出す（無ければNone）。チャンネルごとに一度だけファイルを確認する
+async def restore_buffer(guild_id, channel_id):
+    key = (guild_id, channel_id)
+    if key in buffer_checked:
+        return None
+    buffer_checked.add(key)
+    data = await storage.run_io(_take_spill_sync, buffer_path(guild_id, channel_id))
+    if key in spilled:
+        spilled.discard(key)
+        stats["restored"] += 1
+    return data
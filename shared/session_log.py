@@ -0,0 +1,135 @@
+import os
+import json
+import asyncio
+import storage
+
+# チャンネルごとの会話ログ（追記専用のJSONL）。再起動後に会話を復元する
+SESSION_ROOT = "/app/shared/sessions"
+SESSION_DIR = SESSION_ROOT  # set_namespace で bot ごとのディレクトリに切り替える
+COMPACT_EVERY = 50  # 追記がこの回数を超えたらスナップショットに圧縮
+logged_turns_per_ch = {}  # (guild_id, channel_id) -> ログ済みのターン数
+logged_tail_per_ch = {}  # (guild_id, channel_id) -> ログ済みの最後のターン（続きかどうかの確認用）
+appends_per_ch = {}  # (guild_id, channel_id) -> 前回の圧縮以降の追記回数
+checked_channels = set()  # 復元を試みたチャンネル
+log_locks = {}
+RUNTIME_STATE = (
+    "SESSION_DIR", "logged_turns_per_ch", "logged_tail_per_ch", "appends_per_ch", "checked_channels", "log_locks",
+)  # 再読み込みで引き継ぐ
+
+# botごとにログの保存先を分ける
+def set_namespace(bot_id):
+    global SESSION_DIR
+    SESSION_DIR = os.path.join(SESSION_ROOT, f"{bot_id}")
+
+def log_path(guild_id, channel_id):
+    return os.path.join(SESSION_DIR, f"{guild_id}", f"{channel_id}.jsonl")
+
+def get_log_lock(key):
+    return log_locks.setdefault(key, asyncio.Lock())
+
+def _append_sync(path, record):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+# スナップショット1行のみのログに置き換える（一時ファイル経由で原子的に）
+def _snapshot_sync(path, history):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"type": "snapshot", "history": history}, ensure_ascii=False, separators=(',', ':')) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# ログを再生して履歴（JSON形式）を組み立てる
+def _replay_sync(path):
+    if not os.path.exists(path):
+        return None, 0
+    history, appends = [], 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 書き込み途中で落ちた最終行は無視
+                print(f"[session_log] 壊れた行を無視しました: {path}")
+                continue
+            if record["type"] == "snapshot":
+                history, appends = record["history"], 0
+            elif record["type"] == "turns":
+                history.extend(record["turns"])
+                appends += 1
+    return history, appends
+
+def _mark_logged(key, history):
+    logged_turns_per_ch[key] = len(history)
+    logged_tail_per_ch[key] = history[-1] if history else None
+
+# 履歴がログ済みの履歴の続きか（ターン数と最後のターンで確かめる）
+def _extends_logged(key, history):
+    logged = logged_turns_per_ch.get(key, 0)
+    if logged == 0:
+        return True
+    return logged <= len(history) and logged_tail_per_ch.get(key) == history[logged - 1]
+
+# 起動後初めて触れたチャンネルの履歴を復元（未保存ならNone）
+async def load(guild_id, channel_id):
+    key = (guild_id, channel_id)
+    if key in checked_channels:
+        return None
+    async with get_log_lock(key):
+        checked_channels.add(key)
+        history, appends = await storage.run_io(_replay_sync, log_path(guild_id, channel_id))
+        if history is None:
+            return None
+        _mark_logged(key, history)
+        appends_per_ch[key] = appends
+        return history
+
+# やり取り後の新しいターンを追記（ログ済みの履歴の続きでなければスナップショットで置き換える）
+async def record_exchange(guild_id, channel_id, history):
+    key = (guild_id, channel_id)
+    async with get_log_lock(key):
+        checked_channels.add(key)
+        logged = logged_turns_per_ch.get(key, 0)
+        path = log_path(guild_id, channel_id)
+        if not _extends_logged(key, history) or appends_per_ch.get(key, 0) >= COMPACT_EVERY:
+            await storage.run_io(_snapshot_sync, path, history)
+            appends_per_ch[key] = 0
+        elif logged < len(history):
+            await storage.run_io(_append_sync, path, {"type": "turns", "turns": history[logged:]})
+            appends_per_ch[key] = appends_per_ch.get(key, 0) + 1
+        _mark_logged(key, history)
+
+# 履歴を丸ごと置き換えた場合（ロード・削減）にスナップショットを書く
+async def write_snapshot(guild_id, channel_id, history):
+    key = (guild_id, channel_id)
+    async with get_log_lock(key):
+        checked_channels.add(key)
+        await storage.run_io(_snapshot_sync, log_path(guild_id, channel_id), history)
+        _mark_logged(key, history)
+        appends_per_ch[key] = 0
+
+# 履歴リセット時にログを削除
+async def clear(guild_id, channel_id):
+    key = (guild_id, channel_id)
+    async with get_log_lock(key):
+        checked_channels.add(key)
+        await storage.remove(log_path(guild_id, channel_id))
+        logged_turns_per_ch.pop(key, None)
+        logged_tail_per_ch.pop(key, None)
+        appends_per_ch.pop(key, None)
+
+# メモリから追い出したチャンネルの記録を消す（次に使われたときにログから復元させる）
+def forget(guild_id, channel_id):
+    key = (guild_id, channel_id)
+    checked_channels.discard(key)
+    logged_turns_per_ch.pop(key, None)
+    logged_tail_per_ch.pop(key, None)
+    appends_per_ch.pop(key, None)
+    lock = log_locks.get(key)
+    if lock is not None and not lock.locked():
+        del log_locks[key]
@@ -0,0 +1,123 @@
+import os
+import json
+import fcntl
+import asyncio
+import tempfile
+import contextlib
+import storage
+
+# 複数のbotプロセスで ./shared を安全に共有するための仕組み
+LEASE_DIR = "/app/shared/leases"  # チャンネルごとの応答リース（ロックファイル）
+LEASE_TIMEOUT = 120.0  # リース取得を待つ最大時間（秒）
+LEASE_POLL_INTERVAL = 0.2
+WATCH_INTERVAL = 5.0  # 共有ファイルの変更確認間隔（秒）
+
+# 一時ファイルに書いてから置き換える（読み手が書きかけを見ない）
+def atomic_write_bytes(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+def atomic_write_text(path, text):
+    atomic_write_bytes(path, text.encode("utf-8"))
+
+def atomic_write_json(path, data):
+    atomic_write_text(path, json.dumps(data, ensure_ascii=False))
+
+# プロセス間の排他ロック（path + ".lock" に対する flock）
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    lock_path = f"{path}.lock"
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+    with open(lock_path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+# ロックを取ったうえで JSON を読み、update(data) を適用して原子的に書き戻す
+def update_json_locked(path, update, default=None):
+    with file_lock(path):
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        else:
+            data = {} if default is None else default
+        result = update(data)
+        atomic_write_json(path, data)
+        return data, result
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+# probe() の値（更新時刻・版数など）を監視し、変わったら callback() を呼ぶ（他のプロセスによる変更の取り込み用）
+async def watch(probe, callback, name, interval=WATCH_INTERVAL):
+    last = await storage.run_io(probe)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            current = await storage.run_io(probe)
+            if current != last:
+                last = current
+                print(f"[shared_state] 変更を検知しました: {name}")
+                callback()
+        except Exception as e:
+            print(f"[shared_state] 監視エラー: {name}: {e}")
+
+async def watch_file(path, callback, interval=WATCH_INTERVAL):
+    await watch(lambda: file_mtime(path), callback, path, interval)
+
+# ===== チャンネル応答リース =====
+
+class ChannelLease:
+    def __init__(self, guild_id, channel_id):
+        self.path = os.path.join(LEASE_DIR, f"{guild_id}_{channel_id}.lease")
+        self.file = None
+
+    def _try_acquire(self):
+        os.makedirs(LEASE_DIR, exist_ok=True)
+        f = open(self.path, "a")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self.file = f
+        return True
+
+    def _release(self):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+    # 他のbotが同じチャンネルで応答中なら終わるまで待つ
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + LEASE_TIMEOUT
+        while not await storage.run_io(self._try_acquire):
+            if loop.time() >= deadline:
+                raise TimeoutError(f"チャンネルのリースを取得できませんでした: {self.path}")
+            await asyncio.sleep(LEASE_POLL_INTERVAL)
+        return self
+
+    async def __aexit__(self, *exc):
+        await storage.run_io(self._release)
+        return False
+
+def channel_lease(guild_id, channel_id):
+    return ChannelLease(guild_id, channel_id)
@@ -0,0 +1,102 @@
+import os
+import json
+import sqlite3
+import contextlib
+import shared_state
+
+# botの設定（応答チャンネル・エクスポート上限など）の保存先
+# 同じbotの全シャード（別プロセス・別コンテナ）から同じ内容が見えるよう ./shared 配下に置く
+# STATE_BACKEND: "file"（名前空間ごとのJSONファイル）または "sqlite"（1つのDBファイル）
+STATE_BACKEND = os.getenv("STATE_BACKEND", "file")
+STATE_ROOT = os.getenv("STATE_ROOT", "/app/shared/state")
+STATE_NAMESPACE = os.getenv("STATE_NAMESPACE")  # 複数のbotで設定を共有する場合に同じ値を指定（既定はbotのID）
+
+class FileBackend:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, namespace):
+        return os.path.join(self.directory, f"{namespace}.json")
+
+    def load(self, namespace):
+        path = self.path(namespace)
+        if not os.path.exists(path):
+            return {}
+        with shared_state.file_lock(path, shared=True):
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+
+    # ロックを取って読み直し、update(data) を適用して書き戻す。(data, update の戻り値) を返す
+    def update(self, namespace, update):
+        return shared_state.update_json_locked(self.path(namespace), update)
+
+    # 変更検知用の値（変わっていれば別の値になる）
+    def revision(self, namespace):
+        return shared_state.file_mtime(self.path(namespace))
+
+class SqliteBackend:
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, "state.sqlite3")
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key))")
+            conn.execute("CREATE TABLE IF NOT EXISTS revisions (namespace TEXT PRIMARY KEY, revision INTEGER)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _load(conn, namespace):
+        rows = conn.execute("SELECT key, value FROM kv WHERE namespace = ?", (namespace,))
+        return {key: json.loads(value) for key, value in rows}
+
+    def load(self, namespace):
+        with self._connect() as conn:
+            return self._load(conn, namespace)
+
+    def update(self, namespace, update):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                before = self._load(conn, namespace)
+                data = json.loads(json.dumps(before))
+                result = update(data)
+                for key in before.keys() - data.keys():
+                    conn.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+                for key, value in data.items():
+                    if before.get(key) != value:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+                            (namespace, key, json.dumps(value, ensure_ascii=False))
+                        )
+                conn.execute(
+                    "INSERT INTO revisions (namespace, revision) VALUES (?, 1) "
+                    "ON CONFLICT(namespace) DO UPDATE SET revision = revision + 1",
+                    (namespace,)
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return data, result
+
+    def revision(self, namespace):
+        with self._connect() as conn:
+            row = conn.execute("SELECT revision FROM revisions WHERE namespace = ?", (namespace,)).fetchone()
+        return row[0] if row else None
+
+BACKENDS = {"file": FileBackend, "sqlite": SqliteBackend}
+
+# botごとの保存先を開く
+def open_backend(bot_id, kind=None):
+    kind = kind or STATE_BACKEND
+    if kind not in BACKENDS:
+        raise ValueError(f"不明な STATE_BACKEND です: {kind}")
+    return BACKENDS[kind](os.path.join(STATE_ROOT, STATE_NAMESPACE or f"{bot_id}"))
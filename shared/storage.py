@@ -0,0 +1,69 @@
+import os
+import json
+import asyncio
+import concurrent.futures
+
+# ファイル入出力専用のスレッドプール（スレッド数を制限してスパイク時の増殖を防ぐ）
+IO_WORKERS = 4
+io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="storage")
+
+# 再読み込み時は新しいプールに切り替え、古いプールは実行中・待機中の処理を終えてから閉じる
+def after_reload(old_vars):
+    old_executor = old_vars.get("io_executor")
+    if old_executor is not None and old_executor is not io_executor:
+        old_executor.shutdown(wait=False)
+
+# 同期関数をI/Oスレッドプールで実行
+def run_io(func, *args):
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(io_executor, func, *args)
+
+# ===== 同期版（スレッド内で呼ぶ） =====
+
+def read_text_sync(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def read_json_sync(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def write_json_sync(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+
+def list_subdirs_sync(path):
+    if not os.path.isdir(path):
+        return []
+    return [entry.name for entry in os.scandir(path) if entry.is_dir()]
+
+# フォルダ内の全ファイルを (絶対パス, 相対パス, サイズ) で列挙
+def walk_files_sync(folder_path):
+    files = []
+    for root, _, names in os.walk(folder_path):
+        for name in names:
+            full_path = os.path.join(root, name)
+            files.append((full_path, os.path.relpath(full_path, folder_path), os.path.getsize(full_path)))
+    return files
+
+def remove_sync(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+# ===== 非同期API =====
+
+async def exists(path):
+    return await run_io(os.path.exists, path)
+
+async def read_text(path):
+    return await run_io(read_text_sync, path)
+
+async def read_json(path):
+    return await run_io(read_json_sync, path)
+
+async def remove(path):
+    return await run_io(remove_sync, path)